@@ -10,6 +10,8 @@ from typing import List, Dict, Any
 
 import config # type: ignore
 import rag # type: ignore
+import retrieval_cache # type: ignore
+from context_packer import model_context_budget, pack_context_docs # type: ignore
 from database import AsyncSessionLocal, redis_client # type: ignore
 from fastapi import APIRouter, Depends, HTTPException, Request
 from fastapi.responses import JSONResponse, Response, StreamingResponse
@@ -20,8 +22,12 @@ from langchain_core.prompts import ChatPromptTemplate, PromptTemplate, MessagesP
 from langchain_core.runnables import RunnablePassthrough, RunnableParallel, RunnableBranch, RunnableLambda
 from llm_services import llm # type: ignore
 from outline_client import verify_outline_signature # type: ignore
+from parent_cache import parent_cache # type: ignore
 from pydantic import BaseModel
+from rate_limiter import limiter_stats # type: ignore
 from sqlalchemy import text
+from task_queue import enqueue_task, queue_metrics # type: ignore
+from webhook_events import REFRESH_EVENTS, parse_webhook_event, schedule_document_event, schedule_full_refresh # type: ignore
 from werkzeug.utils import secure_filename
 
 logger = logging.getLogger(__name__)
@@ -112,42 +118,59 @@ def _format_docs_with_metadata(docs: List[Document]) -> dict:
 async def _get_reranked_parent_docs(query: str) -> List[Document]:
     """
     异步检索链，执行 块检索 -> 块重排 -> 父文档获取
+    块检索与重排的结果按 (改写查询, 语料代数) 缓存，见 retrieval_cache
     """
     if not rag.compression_retriever or not rag.parent_store:
         logger.error("RAG components (compression_retriever or parent_store) not initialized.")
         return []
 
-    try:
-        # 1. 获取 Top K (6) 个最相关的 *块*
-        reranked_chunks = await rag.compression_retriever.ainvoke(
-            query
-        )
-    except Exception as e:
-        logger.error(f"Failed during chunk retrieval/reranking (ainvoke): {e}", exc_info=True)
-        return []
+    # 1. 获取 Top K (6) 个最相关的 *块*；相同改写查询在语料未变化时直接复用上次的重排结果
+    #    (命中时跳过 embedding、向量检索与重排三次网络往返)
+    generation, reranked_chunks = await retrieval_cache.lookup(query)
+    if reranked_chunks is None:
+        try:
+            reranked_chunks = await rag.compression_retriever.ainvoke(
+                query
+            )
+        except Exception as e:
+            logger.error(f"Failed during chunk retrieval/reranking (ainvoke): {e}", exc_info=True)
+            return []
+        await retrieval_cache.store(query, generation, reranked_chunks)
 
-    # 2. 从块中提取父文档 ID (保持顺序并去重)
-    parent_ids = []
+    # 2. 从块中提取父文档 ID 及其版本 (保持顺序并去重)
+    parent_keys = []
     seen_ids = set()
     for chunk in reranked_chunks:
         source_id = chunk.metadata.get("source_id")
         if source_id and source_id not in seen_ids:
-            parent_ids.append(source_id)
+            parent_keys.append((source_id, chunk.metadata.get("outline_updated_at_str")))
             seen_ids.add(source_id)
 
-    if not parent_ids:
+    if not parent_keys:
         logger.warning(f"Reranked chunks found, but no source_ids. Query: {query}")
         return []
 
-    # 3. 从 ParentStore (SQLStore) 异步获取唯一的父文档
+    # 3. window 模式：长文档只取 "命中块 + 相邻块" 窗口
+    windowed: Dict[str, Document] = {}
+    if config.RAG_CONTEXT_MODE == "window":
+        try:
+            windowed = await rag.expand_chunk_windows(reranked_chunks)
+        except Exception as e:
+            logger.error(f"Failed to expand chunk windows, falling back to parent docs: {e}", exc_info=True)
+            windowed = {}
+
+    # 4. 其余文档：优先从进程内缓存获取父文档，未命中部分再从 ParentStore 异步获取
+    whole_keys = [key for key in parent_keys if key[0] not in windowed]
     try:
-        parent_docs = await rag.parent_store.amget(parent_ids)
-        # 过滤掉 None (以防万一) 并保持顺序
-        final_docs = [doc for doc in parent_docs if doc is not None]
-        return final_docs
+        parent_docs = await parent_cache.aget_parents(rag.parent_store, whole_keys) if whole_keys else []
     except Exception as e:
-        logger.error(f"Failed to amget parent docs ({parent_ids}) from store: {e}", exc_info=True)
-        return []
+        logger.error(f"Failed to amget parent docs ({[k for k, _ in whole_keys]}) from store: {e}", exc_info=True)
+        parent_docs = [None] * len(whole_keys)
+
+    parents_by_id = {key[0]: doc for key, doc in zip(whole_keys, parent_docs)}
+    # 按重排顺序合并，过滤掉 None (以防万一)
+    final_docs = [windowed.get(sid) or parents_by_id.get(sid) for sid, _ in parent_keys]
+    return [doc for doc in final_docs if doc is not None]
 
 # --- utils ---
 def allowed_file(filename):
@@ -399,6 +422,9 @@ async def api_ask(
     # 获取所选模型的完整属性
     model_properties = models_dict.get(model_id, {})
 
+    # {context} 的 token 预算 (CHAT_MODELS_JSON 中的 "context_budget"，缺省为 RAG_CONTEXT_TOKEN_BUDGET)
+    context_budget = model_context_budget(model_properties)
+
     # 如果请求中未指定 (null)，则使用配置中的默认值
     if temperature is None:
         temperature = model_properties.get("temp", 0.7)
@@ -504,9 +530,12 @@ async def api_ask(
             | RunnablePassthrough.assign(
         docs=itemgetter("rewritten_query") | get_docs_runnable
     )
-            # 2. 格式化父文档，返回 {"context": ..., "sources_map": ...}
+            # 2. 按模型 token 预算打包，再格式化，返回 {"context": ..., "sources_map": ...}
+            #    (编号在打包之后分配，[来源 n] 与 sources_map 始终一致)
             | RunnablePassthrough.assign(
-        formatted_data=lambda x: _format_docs_with_metadata(x["docs"])
+        formatted_data=lambda x: _format_docs_with_metadata(
+            pack_context_docs(x["docs"], x["rewritten_query"], context_budget)
+        )
     )
         # 输出: rewritten_query, input, chat_history, docs, formatted_data
     )
@@ -958,7 +987,7 @@ async def update_all(_user: Dict[str, Any] = Depends(get_current_user)):
         return JSONResponse({"ok": False, "error": "正在刷新中"}, status_code=429)
     try:
         task = {"task": "refresh_all"}
-        await redis_client.lpush("task_queue", json.dumps(task))
+        await enqueue_task(task)
         return JSONResponse({"ok": True, "message": "已开始全量刷新"}, status_code=202)
     except Exception as e:
         await redis_client.delete("refresh:lock")
@@ -984,15 +1013,17 @@ async def refresh_status(_user: Dict[str, Any] = Depends(get_current_user)):
     try:
         counts = await redis_client.mget([
             "refresh:total_queued", "refresh:success_count",
-            "refresh:skipped_count"
+            "refresh:skipped_count", "refresh:listing"
         ])
         total_queued = int(counts[0] or 0)
         success_count = int(counts[1] or 0)
         skipped_count = int(counts[2] or 0)
+        # 文档枚举仍在进行时，total_queued 还会继续增长
+        still_listing = bool(counts[3])
 
         processed_count = success_count + skipped_count
 
-        if total_queued > 0 and processed_count >= total_queued:
+        if not still_listing and total_queued > 0 and processed_count >= total_queued:
             final_message = "刷新完成。"
             status = {"status": "success", "message": final_message}
 
@@ -1009,6 +1040,17 @@ async def refresh_status(_user: Dict[str, Any] = Depends(get_current_user)):
     except (ValueError, TypeError):
         return JSONResponse({"status": "running", "message": "正在计算..."}, headers=NO_CACHE_HEADERS)
 
+# --- /api/tasks/metrics ---
+@api_router.get("/api/tasks/metrics")
+async def tasks_metrics(_user: Dict[str, Any] = Depends(get_current_user)):
+    if not redis_client:
+        return JSONResponse({"status": "disabled", "message": "Redis not configured"}, headers=NO_CACHE_HEADERS)
+    try:
+        return JSONResponse({**(await queue_metrics()), "rate_limits": limiter_stats()}, headers=NO_CACHE_HEADERS)
+    except Exception as e:
+        logger.exception("读取任务队列指标失败 (async): %s", e)
+        return JSONResponse({"error": "读取任务队列指标失败"}, status_code=500, headers=NO_CACHE_HEADERS)
+
 # --- /update/webhook ---
 @api_router.post("/update/webhook")
 async def update_webhook(request: Request):
@@ -1022,7 +1064,26 @@ async def update_webhook(request: Request):
         logger.warning("收到 Webhook 但 Redis 未配置，无法启动延时刷新。")
         return JSONResponse({"ok": False, "error": "任务队列服务未配置"}, status_code=503)
 
-    due_time = int(time.time()) + 60
-    await redis_client.set("webhook:refresh_timer_due", due_time)
-    logger.info("收到 Webhook，刷新计时器至 %s。", time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(due_time)))
-    return JSONResponse({"ok": True, "message": "Timer refreshed"})
\ No newline at end of file
+    try:
+        body = json.loads(raw or b"{}")
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return JSONResponse({"ok": False, "error": "invalid payload"}, status_code=400)
+    if not isinstance(body, dict):
+        return JSONResponse({"ok": False, "error": "invalid payload"}, status_code=400)
+
+    event, doc_id, action = parse_webhook_event(body)
+
+    if doc_id:
+        # 单篇文档事件：按文档防抖，到期后只处理/删除这一篇
+        due_time = await schedule_document_event(doc_id, action)
+        logger.info("收到 Webhook %s (doc %s)，%s 计划于 %s 执行。", event, doc_id, action,
+                    time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(due_time)))
+        return JSONResponse({"ok": True, "message": "Document scheduled", "doc_id": doc_id, "action": action})
+
+    if event in REFRESH_EVENTS:
+        due_time = await schedule_full_refresh()
+        logger.info("收到 Webhook %s，刷新计时器至 %s。", event, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(due_time)))
+        return JSONResponse({"ok": True, "message": "Timer refreshed"})
+
+    logger.debug("忽略 Webhook 事件: %s", event)
+    return JSONResponse({"ok": True, "message": "Ignored"})
@@ -0,0 +1,235 @@
+# app/chunk_writer.py
+# 基于 COPY 的批量块写入器：在单个事务内原子地替换文档的块与父文档
+import logging
+import uuid
+from collections import defaultdict
+from typing import List, Sequence, Tuple
+
+from langchain_core.documents import Document
+from sqlalchemy import text
+
+from database import async_engine
+
+logger = logging.getLogger(__name__)
+
+# 通过 COPY 写入的 langchain_pg_embedding 列 (顺序即 COPY 行顺序)
+CHUNK_COLUMNS = (
+    "langchain_id",
+    "content",
+    "embedding",
+    "source_id",
+    "title",
+    "outline_updated_at_str",
+    "url",
+    "content_hash",
+    "chunk_index",
+    "token_count",
+)
+
+
+class ChunkWriteConflict(RuntimeError):
+    """计划保留的块已被并发写入者删除 (文档在切分之后被另一任务改写)，需重新摄取这些文档。"""
+
+    def __init__(self, source_ids: List[str]):
+        super().__init__(f"concurrent chunk write for documents: {', '.join(source_ids)}")
+        self.source_ids = source_ids
+
+
+# 按文档串行化写入者的事务级咨询锁；先在子查询中排序，保证多文档批次以固定顺序加锁 (避免死锁)
+_LOCK_DOCUMENTS_SQL = (
+    "SELECT pg_advisory_xact_lock(hashtext(s)) FROM (SELECT s FROM unnest(%s::text[]) AS s ORDER BY s) AS t"
+)
+
+
+def _vector_literal(embedding: Sequence[float]) -> str:
+    """pgvector 文本格式: [0.1,0.2,...]"""
+    return "[" + ",".join(str(float(x)) for x in embedding) + "]"
+
+
+def _chunk_row(chunk: Document, embedding: Sequence[float]) -> tuple:
+    metadata = chunk.metadata
+    return (
+        str(uuid.uuid4()),
+        chunk.page_content,
+        _vector_literal(embedding),
+        metadata.get("source_id"),
+        metadata.get("title"),
+        metadata.get("outline_updated_at_str"),
+        metadata.get("url"),
+        metadata.get("content_hash"),
+        metadata.get("chunk_index"),
+        metadata.get("token_count"),
+    )
+
+
+def _plan_writes(existing_rows, new_chunks, kept_chunks):
+    """
+    以加锁后读取的现有行为准，重新配对计划中的块：
+    - kept_chunks (source_id, content_hash, chunk_index) 必须仍有对应的行，否则视为冲突；
+    - 新块若已有相同内容的行 (并发写入者刚写入了同一版本)，复用该行而不重复插入；
+    - 其余现有行删除。
+    返回 (待插入的 (块, 向量), 待删除的 langchain_id, 序号更新 (langchain_id, chunk_index), 冲突的 source_id)。
+    """
+    existing = defaultdict(list)
+    for langchain_id, source_id, content_hash in existing_rows:
+        existing[(source_id, content_hash)].append(langchain_id)
+
+    ordinal_updates, to_insert, conflicts = [], [], set()
+    for source_id, content_hash, chunk_index in kept_chunks:
+        ids = existing.get((source_id, content_hash))
+        if ids:
+            ordinal_updates.append((ids.pop(), chunk_index))
+        else:
+            conflicts.add(source_id)
+
+    for chunk, embedding in new_chunks:
+        ids = existing.get((chunk.metadata.get("source_id"), chunk.metadata.get("content_hash")))
+        if ids:
+            ordinal_updates.append((ids.pop(), chunk.metadata.get("chunk_index")))
+        else:
+            to_insert.append((chunk, embedding))
+
+    to_delete = [langchain_id for ids in existing.values() for langchain_id in ids]
+    return to_insert, to_delete, ordinal_updates, sorted(conflicts)
+
+
+async def replace_document_chunks(
+        new_chunks: Sequence[Tuple[Document, Sequence[float]]],
+        kept_chunks: Sequence[Tuple[str, str, int]],
+        doc_updates: Sequence[dict],
+        parents: Sequence[Tuple[str, bytes]],
+        parent_namespace: str,
+) -> int:
+    """
+    在一个事务中完成一批文档的块替换：
+      0. 对 doc_updates 中的每篇文档加事务级咨询锁，并在锁内重新读取现有块，
+         与计划 (新块 + kept_chunks: (source_id, content_hash, 新 chunk_index)) 重新配对；
+         同一文档的并发摄取因此串行执行且不会产生重复块，计划保留的块已被删除时抛出 ChunkWriteConflict；
+      1. COPY 新块 (含向量字面量) 到临时 staging 表；
+      2. 删除已消失的旧块；
+      3. 从 staging 表 INSERT ... SELECT 到 langchain_pg_embedding；
+      4. 同步保留块的序号与文档元数据 (doc_updates: source_id/title/updated_at/url)；
+      5. upsert 文档清单 documents (doc_updates 中的 content_hash/chunk_count/token_count)；
+      6. upsert 父文档 (parents: 已序列化的 (key, bytes))。
+    检索侧只会看到替换前或替换后的完整状态，不存在“零块”的中间窗口。
+    返回写入的新块数量。
+    """
+    columns = ", ".join(CHUNK_COLUMNS)
+    source_ids = sorted({update["source_id"] for update in doc_updates})
+
+    async with async_engine.begin() as conn:
+        raw_conn = await conn.get_raw_connection()
+        driver_conn = raw_conn.driver_connection  # psycopg.AsyncConnection (与 conn 同一事务)
+
+        async with driver_conn.cursor() as cur:
+            await cur.execute(_LOCK_DOCUMENTS_SQL, (source_ids,))
+            await cur.execute(
+                "SELECT langchain_id, source_id, content_hash FROM langchain_pg_embedding "
+                "WHERE source_id = ANY(%s::text[])",
+                (source_ids,)
+            )
+            new_chunks, ids_to_delete, ordinal_updates, conflicts = _plan_writes(
+                await cur.fetchall(), new_chunks, kept_chunks
+            )
+            if conflicts:
+                raise ChunkWriteConflict(conflicts)
+
+            if new_chunks:
+                await cur.execute(
+                    "CREATE TEMP TABLE chunk_staging "
+                    "(LIKE langchain_pg_embedding INCLUDING DEFAULTS) ON COMMIT DROP"
+                )
+                async with cur.copy(f"COPY chunk_staging ({columns}) FROM STDIN") as copy:
+                    for chunk, embedding in new_chunks:
+                        await copy.write_row(_chunk_row(chunk, embedding))
+
+            if ids_to_delete:
+                await cur.execute(
+                    "DELETE FROM langchain_pg_embedding WHERE langchain_id = ANY(%s::uuid[])",
+                    ([str(i) for i in ids_to_delete],)
+                )
+
+            if new_chunks:
+                await cur.execute(
+                    f"INSERT INTO langchain_pg_embedding ({columns}) SELECT {columns} FROM chunk_staging"
+                )
+
+            if ordinal_updates:
+                await cur.execute(
+                    """
+                    UPDATE langchain_pg_embedding e SET chunk_index = u.idx
+                    FROM unnest(%s::uuid[], %s::int[]) AS u(id, idx)
+                    WHERE e.langchain_id = u.id AND e.chunk_index IS DISTINCT FROM u.idx
+                    """,
+                    ([str(i) for i, _ in ordinal_updates], [idx for _, idx in ordinal_updates])
+                )
+
+            if doc_updates:
+                await cur.executemany(
+                    """
+                    UPDATE langchain_pg_embedding
+                    SET title = %(title)s, outline_updated_at_str = %(updated_at)s, url = %(url)s
+                    WHERE source_id = %(source_id)s
+                    """,
+                    list(doc_updates)
+                )
+                await cur.executemany(
+                    """
+                    INSERT INTO documents (source_id, title, outline_updated_at_str, content_hash,
+                                           chunk_count, token_count, last_ingested_at)
+                    VALUES (%(source_id)s, %(title)s, %(updated_at)s, %(content_hash)s,
+                            %(chunk_count)s, %(token_count)s, now())
+                    ON CONFLICT (source_id) DO UPDATE SET
+                        title = EXCLUDED.title,
+                        outline_updated_at_str = EXCLUDED.outline_updated_at_str,
+                        content_hash = EXCLUDED.content_hash,
+                        chunk_count = EXCLUDED.chunk_count,
+                        token_count = EXCLUDED.token_count,
+                        last_ingested_at = EXCLUDED.last_ingested_at
+                    """,
+                    list(doc_updates)
+                )
+
+            if parents:
+                await cur.executemany(
+                    """
+                    INSERT INTO langchain_key_value_stores (key, value, namespace)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (key, namespace) DO UPDATE SET value = EXCLUDED.value
+                    """,
+                    [(key, value, parent_namespace) for key, value in parents]
+                )
+
+    logger.debug(
+        f"replace_document_chunks: +{len(new_chunks)} chunks, -{len(ids_to_delete)} chunks, "
+        f"{len(parents)} parents."
+    )
+    return len(new_chunks)
+
+
+async def delete_documents(source_ids: Sequence[str], parent_namespace: str) -> Tuple[int, int]:
+    """
+    在一个事务中删除多篇文档的全部块、父文档与清单行 (每张表一条语句，不逐篇往返)。
+    返回 (删除的块数, 删除的父文档数)。
+    """
+    if not source_ids:
+        return 0, 0
+
+    async with async_engine.begin() as conn:
+        # 与 replace_document_chunks 使用同一把按文档的锁，删除不会与进行中的写入交错
+        raw_conn = await conn.get_raw_connection()
+        async with raw_conn.driver_connection.cursor() as cur:
+            await cur.execute(_LOCK_DOCUMENTS_SQL, (sorted(set(source_ids)),))
+        chunks_deleted = (await conn.execute(
+            text("DELETE FROM langchain_pg_embedding WHERE source_id = ANY(:source_ids)"),
+            {"source_ids": list(source_ids)}
+        )).rowcount
+        parents_deleted = (await conn.execute(
+            text("DELETE FROM langchain_key_value_stores WHERE namespace = :ns AND key = ANY(:source_ids)"),
+            {"ns": parent_namespace, "source_ids": list(source_ids)}
+        )).rowcount
+        await conn.execute(
+            text("DELETE FROM documents WHERE source_id = ANY(:source_ids)"),
+            {"source_ids": list(source_ids)}
+        )
+    return chunks_deleted, parents_deleted
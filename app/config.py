@@ -20,13 +20,41 @@ OUTLINE_API_URL = os.getenv("OUTLINE_API_URL", "").rstrip("/")
 OUTLINE_DISPLAY_URL = os.getenv("OUTLINE_DISPLAY_URL", "").rstrip("/")
 OUTLINE_API_TOKEN = os.getenv("OUTLINE_API_TOKEN", "")
 OUTLINE_WEBHOOK_SECRET = os.getenv("OUTLINE_WEBHOOK_SECRET", "123").strip()
-OUTLINE_WEBHOOK_SIGN = os.getenv("OUTLINE_WEBHOOK_SIGN", "True").lower() == "True"
+OUTLINE_WEBHOOK_SIGN = os.getenv("OUTLINE_WEBHOOK_SIGN", "true").lower() == "true"
+# Outline API 共享连接池 (每个 worker 进程一个长连接 httpx.AsyncClient)
+OUTLINE_HTTP_MAX_CONNECTIONS = int(os.getenv("OUTLINE_HTTP_MAX_CONNECTIONS", "20"))
+OUTLINE_HTTP_MAX_KEEPALIVE = int(os.getenv("OUTLINE_HTTP_MAX_KEEPALIVE", "10"))
+OUTLINE_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("OUTLINE_HTTP_KEEPALIVE_EXPIRY", "30"))
+# 文档枚举 (collections.list / documents.list) 的分页与并发
+OUTLINE_LIST_PAGE_SIZE = int(os.getenv("OUTLINE_LIST_PAGE_SIZE", "100"))
+OUTLINE_LIST_CONCURRENCY = int(os.getenv("OUTLINE_LIST_CONCURRENCY", "4")) # 同时枚举的知识库数
+OUTLINE_LIST_PAGE_WINDOW = int(os.getenv("OUTLINE_LIST_PAGE_WINDOW", "2")) # 每个知识库每轮并发请求的页数
 
 SILICONFLOW_API_KEY = os.getenv("SILICONFLOW_API_KEY", "")
 SILICONFLOW_BASE_URL = os.getenv("SILICONFLOW_BASE_URL", "https://api.siliconflow.cn").rstrip("/")
 
+# 上游 API 自适应限流 (每个进程、每个主机一个限流器)：令牌桶速率/突发量 + AIMD 并发上限
+OUTLINE_RATE_LIMIT_RPS = float(os.getenv("OUTLINE_RATE_LIMIT_RPS", "20"))
+OUTLINE_RATE_LIMIT_BURST = int(os.getenv("OUTLINE_RATE_LIMIT_BURST", "20"))
+OUTLINE_MAX_CONCURRENCY = int(os.getenv("OUTLINE_MAX_CONCURRENCY", "16"))
+SILICONFLOW_RATE_LIMIT_RPS = float(os.getenv("SILICONFLOW_RATE_LIMIT_RPS", "20"))
+SILICONFLOW_RATE_LIMIT_BURST = int(os.getenv("SILICONFLOW_RATE_LIMIT_BURST", "20"))
+SILICONFLOW_MAX_CONCURRENCY = int(os.getenv("SILICONFLOW_MAX_CONCURRENCY", "16"))
+
 # 保留模型名称配置
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "BAAI/bge-m3")
+# Embedding 请求打包：单请求 token 上限 (cl100k_base 估算)、条目上限与并发请求数
+EMBEDDING_MAX_BATCH_TOKENS = int(os.getenv("EMBEDDING_MAX_BATCH_TOKENS", "8000"))
+EMBEDDING_MAX_BATCH_SIZE = int(os.getenv("EMBEDDING_MAX_BATCH_SIZE", "32"))
+EMBEDDING_REQUEST_CONCURRENCY = int(os.getenv("EMBEDDING_REQUEST_CONCURRENCY", "4"))
+# Embedding 缓存前置层：进程内 LRU (字节上限) + 可选 Redis 层 (TTL 秒，0 表示不启用)
+EMBEDDING_CACHE_LRU_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_LRU_MAX_BYTES", str(64 * 1024 * 1024)))
+EMBEDDING_CACHE_REDIS_TTL = int(os.getenv("EMBEDDING_CACHE_REDIS_TTL", "604800"))
+# 缓存向量的存储格式: float32 (无损) 或 float16 (体积减半)
+EMBEDDING_CACHE_FORMAT = os.getenv("EMBEDDING_CACHE_FORMAT", "float32").lower()
+# 查询向量缓存 (按规范化查询文本)：进程内 LRU (字节上限) + 可选 Redis 层 (TTL 秒，0 表示不启用)
+QUERY_EMBEDDING_CACHE_LRU_MAX_BYTES = int(os.getenv("QUERY_EMBEDDING_CACHE_LRU_MAX_BYTES", str(8 * 1024 * 1024)))
+QUERY_EMBEDDING_CACHE_REDIS_TTL = int(os.getenv("QUERY_EMBEDDING_CACHE_REDIS_TTL", "86400"))
 RERANKER_MODEL = os.getenv("RERANKER_MODEL", "BAAI/bge-reranker-v2-m3")
 # 用于分类器、重写器等内部任务的基础模型
 BASE_CHAT_MODEL = os.getenv("BASE_CHAT_MODEL", "Qwen/Qwen3-Next-80B-A3B-Instruct")
@@ -252,7 +280,52 @@ HISTORY_AWARE_PROMPT_TEMPLATE = os.getenv("HISTORY_AWARE_PROMPT_TEMPLATE", DEFAU
 # --- RAG/检索参数 ---
 TOP_K = int(os.getenv("TOP_K", "12"))
 K = int(os.getenv("K", "3"))
+# 上下文构造方式: "window" (命中块 + 相邻块窗口) 或 "parent" (整篇父文档)
+RAG_CONTEXT_MODE = os.getenv("RAG_CONTEXT_MODE", "window").lower()
+RAG_CONTEXT_WINDOW = int(os.getenv("RAG_CONTEXT_WINDOW", "1")) # 命中块前后各取的相邻块数
+RAG_WHOLE_DOC_MAX_CHUNKS = int(os.getenv("RAG_WHOLE_DOC_MAX_CHUNKS", "4")) # 块数不超过此值的短文档直接使用整篇
+# {context} 的默认 token 预算；可在 CHAT_MODELS_JSON 中为单个模型设置 "context_budget" 覆盖
+RAG_CONTEXT_TOKEN_BUDGET = int(os.getenv("RAG_CONTEXT_TOKEN_BUDGET", "12000"))
+# 混合检索：向量检索与词法检索 (pg_trgm) 并行，按倒数排名融合 (RRF) 后取 TOP_K 交给重排器
+HYBRID_SEARCH_ENABLED = os.getenv("HYBRID_SEARCH_ENABLED", "true").lower() == "true"
+HYBRID_VECTOR_K = int(os.getenv("HYBRID_VECTOR_K", str(TOP_K))) # 向量候选池大小
+HYBRID_LEXICAL_K = int(os.getenv("HYBRID_LEXICAL_K", str(TOP_K))) # 词法候选池大小
+HYBRID_LEXICAL_WEIGHT = float(os.getenv("HYBRID_LEXICAL_WEIGHT", "1.0")) # 词法排名的融合权重 (向量为 1.0)
+HYBRID_RRF_K = int(os.getenv("HYBRID_RRF_K", "60")) # RRF 平滑常数
+# 检索结果缓存：按 (规范化的改写查询, 语料代数) 缓存重排后的块列表；语料变更时代数递增即失效
+RETRIEVAL_CACHE_ENABLED = os.getenv("RETRIEVAL_CACHE_ENABLED", "true").lower() == "true"
+RETRIEVAL_CACHE_TTL = int(os.getenv("RETRIEVAL_CACHE_TTL", "86400")) # 仅用于回收旧代数的键
 REFRESH_BATCH_SIZE = int(os.getenv("REFRESH_BATCH_SIZE", "100"))
+# 单个批处理任务在 Redis 中内联携带的文档正文总量上限 (字节)；超出部分的文档由 worker 向 Outline 重新拉取
+REFRESH_INLINE_TEXT_MAX_BYTES = int(os.getenv("REFRESH_INLINE_TEXT_MAX_BYTES", str(1024 * 1024)))
+# 每个 worker 进程内父文档缓存的容量上限 (字节)
+PARENT_CACHE_MAX_BYTES = int(os.getenv("PARENT_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+# 单个批处理任务内同时向 Outline 拉取文档 (info + export) 的最大并发数
+OUTLINE_FETCH_CONCURRENCY = int(os.getenv("OUTLINE_FETCH_CONCURRENCY", "8"))
+# 摄取流水线 (fetch -> split -> embed -> write) 各阶段的并发与队列深度
+INGEST_SPLIT_CONCURRENCY = int(os.getenv("INGEST_SPLIT_CONCURRENCY", "2"))
+INGEST_EMBED_CONCURRENCY = int(os.getenv("INGEST_EMBED_CONCURRENCY", "4"))
+INGEST_EMBED_BATCH_SIZE = int(os.getenv("INGEST_EMBED_BATCH_SIZE", "8")) # embed 阶段每次合并的文档数上限
+INGEST_WRITE_CONCURRENCY = int(os.getenv("INGEST_WRITE_CONCURRENCY", "1"))
+INGEST_WRITE_BATCH_SIZE = int(os.getenv("INGEST_WRITE_BATCH_SIZE", "8")) # write 阶段每次合并写入的文档数上限
+INGEST_QUEUE_DEPTH = int(os.getenv("INGEST_QUEUE_DEPTH", "16")) # 每个阶段输入队列的最大文档数
+# Webhook 增量更新：同一文档在该秒数内的连续事件合并为一次处理
+WEBHOOK_DEBOUNCE_SECONDS = int(os.getenv("WEBHOOK_DEBOUNCE_SECONDS", "30"))
+# 周期性全量对账 (refresh_all) 的间隔秒数，0 表示禁用
+REFRESH_RECONCILE_INTERVAL = int(os.getenv("REFRESH_RECONCILE_INTERVAL", str(6 * 3600)))
+# 任务队列 (Redis Streams)：未确认的任务在该秒数内无心跳即被其他 worker 回收重试
+TASK_VISIBILITY_TIMEOUT = int(os.getenv("TASK_VISIBILITY_TIMEOUT", "300"))
+TASK_MAX_ATTEMPTS = int(os.getenv("TASK_MAX_ATTEMPTS", "3")) # 超过该投递次数的任务转入死信流
+TASK_STREAM_MAXLEN = int(os.getenv("TASK_STREAM_MAXLEN", "10000")) # 死信流的近似保留长度 (任务流不裁剪，已完成的条目即时删除)
+TASK_RETRY_BASE_DELAY = int(os.getenv("TASK_RETRY_BASE_DELAY", "30")) # 失败重试的初始退避秒数 (指数增长)
+# Web 进程是否同时运行任务处理器与延时任务调度器；设为 false 时需单独运行 python -m worker
+RUN_BACKGROUND_WORKERS = os.getenv("RUN_BACKGROUND_WORKERS", "true").lower() == "true"
+# 每个进程同时执行的任务数 (总槽位)，以及各任务类型的并发上限
+TASK_WORKER_SLOTS = int(os.getenv("TASK_WORKER_SLOTS", "4"))
+TASK_SLOTS_REFRESH_ALL = int(os.getenv("TASK_SLOTS_REFRESH_ALL", "1"))
+TASK_SLOTS_PROCESS_DOC_BATCH = int(os.getenv("TASK_SLOTS_PROCESS_DOC_BATCH", "3"))
+TASK_SLOTS_DELETE_DOCS = int(os.getenv("TASK_SLOTS_DELETE_DOCS", "1"))
+TASK_DRAIN_TIMEOUT = int(os.getenv("TASK_DRAIN_TIMEOUT", "30")) # 关闭时等待进行中任务完成的秒数
 
 # --- OIDC (GitLab) ---
 GITLAB_CLIENT_ID = os.getenv("GITLAB_CLIENT_ID", "")
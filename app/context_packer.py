@@ -0,0 +1,114 @@
+# app/context_packer.py
+# 按 token 预算打包 RAG 上下文：按重排顺序贪心装入，放不下的文档压缩为与问题最相关的句子
+import logging
+import re
+from typing import List, Optional
+
+from langchain_core.documents import Document
+
+import config
+from llm_services import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# 每篇文档在 {context} 中的固定开销 (来源编号、标题、URL 行) 的估计值
+_PER_DOC_OVERHEAD_TOKENS = 32
+# 剩余预算低于该值时不再尝试压缩装入
+_MIN_EXCERPT_TOKENS = 64
+
+_SENTENCE_SPLIT_RE = re.compile(r"(?<=[。！？；!?;])|\n+")
+_WORD_RE = re.compile(r"[A-Za-z0-9_\-.]+|[一-鿿]")
+
+
+def model_context_budget(model_properties: dict) -> int:
+    """读取 CHAT_MODELS_JSON 中模型的 "context_budget" (tokens)，缺省使用 RAG_CONTEXT_TOKEN_BUDGET。"""
+    try:
+        return int(model_properties.get("context_budget") or config.RAG_CONTEXT_TOKEN_BUDGET)
+    except (TypeError, ValueError):
+        return config.RAG_CONTEXT_TOKEN_BUDGET
+
+
+def _doc_tokens(doc: Document) -> int:
+    """优先使用摄取时预计算的 token_count，旧数据则现场计算。"""
+    token_count = doc.metadata.get("token_count")
+    if isinstance(token_count, int) and token_count > 0:
+        return token_count
+    return count_tokens(doc.page_content)
+
+
+def _query_terms(query: str) -> set:
+    """查询词项：英文/数字按词，中文按单字及相邻二元组。"""
+    tokens = [t.lower() for t in _WORD_RE.findall(query)]
+    terms = set(tokens)
+    terms.update(a + b for a, b in zip(tokens, tokens[1:]) if len(a) == 1 and len(b) == 1)
+    return terms
+
+
+def _excerpt(content: str, query_terms: set, budget: int) -> Optional[str]:
+    """挑选与查询最相关的整句 (不截断句子)，按原文顺序拼接，总量不超过 budget。"""
+    sentences = [s.strip() for s in _SENTENCE_SPLIT_RE.split(content) if s and s.strip()]
+    if not sentences:
+        return None
+
+    scored = []
+    for idx, sentence in enumerate(sentences):
+        lowered = sentence.lower()
+        score = sum(1 for term in query_terms if term in lowered)
+        if score:
+            scored.append((score, idx))
+    scored.sort(key=lambda x: (-x[0], x[1]))
+
+    chosen, used = [], 0
+    for _score, idx in scored:
+        n = count_tokens(sentences[idx])
+        if used + n > budget:
+            continue
+        chosen.append(idx)
+        used += n
+
+    if not chosen:
+        return None
+    chosen.sort()
+    parts, prev = [], None
+    for idx in chosen:
+        if prev is not None and idx != prev + 1:
+            parts.append("……")
+        parts.append(sentences[idx])
+        prev = idx
+    return "\n".join(parts)
+
+
+def pack_context_docs(docs: List[Document], query: str, budget: int) -> List[Document]:
+    """
+    docs 已按重排分数降序排列。按顺序贪心装入完整文档；
+    放不下的文档压缩为与查询最相关的句子，仍放不下则丢弃。
+    返回的列表即最终 [来源 n] 的编号顺序。
+    """
+    if budget <= 0:
+        return docs
+
+    packed, remaining = [], budget
+    terms = _query_terms(query or "")
+
+    for doc in docs:
+        need = _doc_tokens(doc) + _PER_DOC_OVERHEAD_TOKENS
+        if need <= remaining:
+            packed.append(doc)
+            remaining -= need
+            continue
+
+        excerpt_budget = remaining - _PER_DOC_OVERHEAD_TOKENS
+        if excerpt_budget < _MIN_EXCERPT_TOKENS:
+            continue
+        excerpt = _excerpt(doc.page_content, terms, excerpt_budget)
+        if not excerpt:
+            continue
+        excerpt_tokens = count_tokens(excerpt)
+        packed.append(Document(
+            page_content=excerpt,
+            metadata={**doc.metadata, "token_count": excerpt_tokens, "excerpted": True}
+        ))
+        remaining -= excerpt_tokens + _PER_DOC_OVERHEAD_TOKENS
+
+    logger.debug(f"Context packed: {len(packed)}/{len(docs)} docs, {budget - remaining}/{budget} tokens.")
+    return packed
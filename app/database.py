@@ -1,4 +1,5 @@
 # app/database.py
+import asyncio
 import logging
 import urllib.parse
 
@@ -38,6 +39,8 @@ AsyncSessionLocal = async_sessionmaker(
 
 # 异步 Redis 连接
 redis_client = None
+# 二进制值 (embedding 缓存等) 专用连接：不做 UTF-8 解码
+redis_binary_client = None
 if config.REDIS_URL:
     try:
         parsed_url = urllib.parse.urlparse(config.REDIS_URL)
@@ -55,16 +58,50 @@ if config.REDIS_URL:
             db=db_num,
             decode_responses=True
         )
+        redis_binary_client = redis.Redis(
+            host=parsed_url.hostname,
+            port=parsed_url.port,
+            password=parsed_url.password,
+            db=db_num,
+            decode_responses=False
+        )
         logger.info("Redis (asyncio) 客户端已配置。")
     except Exception as e:
         logger.critical("Failed to configure async Redis: %s", e)
         redis_client = None
+        redis_binary_client = None
 else:
     logger.warning("REDIS_URL not set, refresh task status will not be available.")
 
 # 基础表结构 SQL
 PRE_TX_SQL = "CREATE EXTENSION IF NOT EXISTS vector;"
 
+# 词法检索 (HYBRID_SEARCH_ENABLED) 所需的扩展与索引；索引在初始化锁之外后台并发创建
+TRGM_EXTENSION_SQL = "CREATE EXTENSION IF NOT EXISTS pg_trgm"
+TRGM_INDEX_NAME = "idx_langchain_embedding_content_trgm"
+TRGM_INDEX_SQL = f"""
+CREATE INDEX CONCURRENTLY IF NOT EXISTS {TRGM_INDEX_NAME} ON langchain_pg_embedding
+    USING gin (content gin_trgm_ops)
+"""
+# 只允许一个进程创建 trigram 索引 (其余进程跳过，不阻塞启动)
+_TRGM_INDEX_LOCK_KEY = 9876543211
+
+# pg_trgm 是否可用 (db_init 中检测)；不可用时检索退化为纯向量
+_trgm_available = False
+# pg_trgm 能否从汉字中提取 trigram：取决于数据库的 LC_CTYPE，C/POSIX 区域下汉字不被视为单词字符，
+# 中文子串无法走 GIN 索引而退化为全表扫描
+_trgm_cjk_supported = False
+_trgm_index_task = None
+
+
+def lexical_search_available() -> bool:
+    return config.HYBRID_SEARCH_ENABLED and _trgm_available
+
+
+def lexical_cjk_supported() -> bool:
+    return _trgm_cjk_supported
+
+
 TX_INIT_SQL = f"""
 CREATE TABLE IF NOT EXISTS users (
   id TEXT PRIMARY KEY,
@@ -111,6 +148,16 @@ CREATE TABLE IF NOT EXISTS langchain_key_value_stores (
     namespace TEXT NOT NULL,
     PRIMARY KEY (key, namespace)
 );
+
+CREATE TABLE IF NOT EXISTS documents (
+  source_id TEXT PRIMARY KEY,
+  title TEXT,
+  outline_updated_at_str TEXT,
+  content_hash TEXT,
+  chunk_count INTEGER NOT NULL DEFAULT 0,
+  token_count INTEGER,
+  last_ingested_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
 """
 # 索引 'idx_langchain_kv_namespace' 已被主键覆盖，无需单独创建
 # PGVector 表结构 (v2 显式列)
@@ -125,22 +172,79 @@ CREATE TABLE IF NOT EXISTS langchain_pg_embedding (
     title TEXT,
     outline_updated_at_str TEXT,
     url TEXT,
+    content_hash TEXT,
+    chunk_index INTEGER,
+    token_count INTEGER,
     
     created_at TIMESTAMPTZ DEFAULT now()
 );
 """
 
+# 已有部署的增量列迁移 (幂等)
+PGVECTOR_MIGRATION_SQL = """
+ALTER TABLE langchain_pg_embedding ADD COLUMN IF NOT EXISTS content_hash TEXT;
+ALTER TABLE langchain_pg_embedding ADD COLUMN IF NOT EXISTS chunk_index INTEGER;
+ALTER TABLE langchain_pg_embedding ADD COLUMN IF NOT EXISTS token_count INTEGER;
+"""
+
+# 文档清单 (documents) 的一次性回填：仅在清单为空时从已有块聚合生成 (幂等)
+DOCUMENTS_BACKFILL_SQL = """
+INSERT INTO documents (source_id, title, outline_updated_at_str, chunk_count, token_count, last_ingested_at)
+SELECT source_id, max(title), max(outline_updated_at_str), count(*), sum(token_count), max(created_at)
+FROM langchain_pg_embedding
+WHERE source_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM documents)
+GROUP BY source_id
+ON CONFLICT (source_id) DO NOTHING
+"""
+
 # 2. 将 CREATE INDEX 移到单独的变量
 PGVECTOR_INDEX_SQL = f"""
 CREATE INDEX IF NOT EXISTS idx_langchain_embedding_source_id ON langchain_pg_embedding(source_id);
 
+CREATE INDEX IF NOT EXISTS idx_langchain_embedding_source_chunk ON langchain_pg_embedding(source_id, chunk_index);
+
 CREATE INDEX IF NOT EXISTS hnsw_embedding_idx ON langchain_pg_embedding
     USING hnsw (embedding vector_cosine_ops);
 """
 
+
+async def _ensure_trgm_index():
+    """
+    后台以 CONCURRENTLY 创建 trigram 索引 (不阻塞写入与启动)。
+    之前中断的并发创建会留下 INVALID 索引，先删除再重建。
+    """
+    try:
+        async with async_engine.connect() as conn:
+            conn_ac = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            if not (await conn_ac.execute(text(f"SELECT pg_try_advisory_lock({_TRGM_INDEX_LOCK_KEY})"))).scalar():
+                return
+            try:
+                valid = (await conn_ac.execute(
+                    text("""
+                         SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+                         WHERE c.relname = :name
+                         """),
+                    {"name": TRGM_INDEX_NAME}
+                )).scalar()
+                if valid:
+                    return
+                if valid is False:
+                    logger.warning(f"发现未完成的索引 {TRGM_INDEX_NAME}，重新创建。")
+                    await conn_ac.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {TRGM_INDEX_NAME}"))
+                logger.info(f"正在后台并发创建索引 {TRGM_INDEX_NAME} ...")
+                await conn_ac.execute(text(TRGM_INDEX_SQL))
+                logger.info(f"索引 {TRGM_INDEX_NAME} 创建完成。")
+            finally:
+                await conn_ac.execute(text(f"SELECT pg_advisory_unlock({_TRGM_INDEX_LOCK_KEY})"))
+    except Exception as e:
+        # 索引只影响词法检索的速度，不影响正确性
+        logger.error(f"创建索引 {TRGM_INDEX_NAME} 失败: {e}", exc_info=True)
+
 # 异步数据库初始化
 async def db_init():
     """异步初始化数据库"""
+    global _trgm_available, _trgm_cjk_supported, _trgm_index_task
+
     async with async_engine.connect() as conn_lock:
         conn_ac = await conn_lock.execution_options(isolation_level="AUTOCOMMIT")
         await conn_ac.execute(text("SELECT pg_advisory_lock(9876543210)"))
@@ -150,6 +254,19 @@ async def db_init():
             # 启用 pgvector 扩展
             await conn_ac.execute(text(PRE_TX_SQL))
 
+            # 词法检索需要 pg_trgm；无权限创建时退化为纯向量检索，不中断启动
+            if config.HYBRID_SEARCH_ENABLED:
+                try:
+                    await conn_ac.execute(text(TRGM_EXTENSION_SQL))
+                    _trgm_available = True
+                    _trgm_cjk_supported = bool((await conn_ac.execute(
+                        text("SELECT array_length(show_trgm('中文检索'), 1)")
+                    )).scalar())
+                    if not _trgm_cjk_supported:
+                        logger.warning("数据库区域设置下 pg_trgm 无法索引汉字，词法检索仅使用英文/数字词项。")
+                except Exception as e:
+                    logger.warning(f"无法启用 pg_trgm 扩展，混合检索退化为纯向量检索: {e}")
+
             async with async_engine.connect() as conn_tx:
                 async with conn_tx.begin():
                     logger.info("数据库事务已开始，正在执行 INIT_SQL...")
@@ -158,10 +275,18 @@ async def db_init():
                         await conn_tx.execute(text(sql_command))
                     # 新增: 确保 PGVector 表存在
                     await conn_tx.execute(text(PGVECTOR_TABLE_SQL))
+                    migration_commands = [cmd.strip() for cmd in PGVECTOR_MIGRATION_SQL.split(';') if cmd.strip()]
+                    for sql_command in migration_commands:
+                        await conn_tx.execute(text(sql_command))
+                    await conn_tx.execute(text(DOCUMENTS_BACKFILL_SQL))
                     await conn_tx.execute(text("ANALYZE"))
 
             logger.info("数据库表结构初始化/检查完成 (异步)。")
 
+            # 旧的 pickle 父文档一次性改写为 v1 编码 (docstore 依赖本模块，延迟导入)
+            from docstore import ensure_legacy_rows_migrated
+            await ensure_legacy_rows_migrated(conn_ac)
+
             # (使用 conn_ac, 它是 AUTOCOMMIT 模式)
             logger.info("正在 (异步) 检查并创建索引 (这可能需要一些时间)...")
 
@@ -179,4 +304,7 @@ async def db_init():
 
         finally:
             logger.info("释放数据库咨询锁...")
-            await conn_ac.execute(text("SELECT pg_advisory_unlock(9876543210)"))
\ No newline at end of file
+            await conn_ac.execute(text("SELECT pg_advisory_unlock(9876543210)"))
+
+    if _trgm_available and _trgm_index_task is None:
+        _trgm_index_task = asyncio.create_task(_ensure_trgm_index())
\ No newline at end of file
@@ -0,0 +1,308 @@
+# app/docstore.py
+# 父文档存储：版本化、压缩、元数据与正文分离的编码 (取代 pickle)
+#
+# 编码格式 (v1):
+#   [0]        版本字节 0x01
+#   [1:5]      header 长度 (uint32, 大端)
+#   [5:5+H]    JSON header: {"metadata": {...}, "body_len": N, "frame_size": F, "frames": [[offset, clen], ...]}
+#   [5+H:]     正文 UTF-8 按 frame_size 分帧、逐帧 zlib 压缩后的拼接
+#
+# 分帧压缩使得读取正文的某个字节区间时，只需从数据库取回并解压覆盖该区间的帧。
+#
+# 旧的 pickle 行由 db_init 在启动时 (持有初始化咨询锁) 自动迁移一次，也可手动执行:
+#     python docstore.py migrate
+import asyncio
+import json
+import logging
+import struct
+import sys
+import zlib
+from typing import AsyncIterator, List, Optional, Sequence, Tuple
+
+from langchain_core.documents import Document
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+logger = logging.getLogger(__name__)
+
+# ParentStore 在 langchain_key_value_stores 中使用的 namespace
+PARENT_STORE_NAMESPACE = "rag_parent_documents"
+
+FORMAT_VERSION = 0x01
+FRAME_SIZE = 64 * 1024
+COMPRESSION_LEVEL = 6
+
+_PREFIX = struct.Struct(">BI")
+# pickle 协议 2+ 的首字节，用于识别旧数据
+_LEGACY_PICKLE_PREFIX = 0x80
+# 迁移完成标记 (同表的独立 namespace)，之后的启动不再扫描父文档
+_MIGRATION_MARKER_NAMESPACE = "rag_meta"
+_MIGRATION_MARKER_KEY = "parent_format_v1_migrated"
+
+# 在 SQL 中解析 header 长度 (与 _PREFIX 对应)
+_SQL_HEADER_LEN = (
+    "((get_byte(value, 1) << 24) | (get_byte(value, 2) << 16) "
+    "| (get_byte(value, 3) << 8) | get_byte(value, 4))"
+)
+
+
+def encode_parent_document(doc: Document) -> bytes:
+    """将 Document 编码为 v1 字节串。"""
+    body = doc.page_content.encode("utf-8")
+    frames, chunks, offset = [], [], 0
+    for i in range(0, len(body), FRAME_SIZE):
+        compressed = zlib.compress(body[i:i + FRAME_SIZE], COMPRESSION_LEVEL)
+        frames.append([offset, len(compressed)])
+        chunks.append(compressed)
+        offset += len(compressed)
+
+    header = json.dumps(
+        {"metadata": doc.metadata, "body_len": len(body), "frame_size": FRAME_SIZE, "frames": frames},
+        ensure_ascii=False,
+        separators=(",", ":"),
+    ).encode("utf-8")
+    return _PREFIX.pack(FORMAT_VERSION, len(header)) + header + b"".join(chunks)
+
+
+def _parse_header(value: bytes) -> Tuple[dict, int]:
+    """返回 (header, 数据区起始偏移)。"""
+    version, header_len = _PREFIX.unpack_from(value, 0)
+    if version != FORMAT_VERSION:
+        raise ValueError(f"unknown parent document version: {version}")
+    start = _PREFIX.size
+    return json.loads(value[start:start + header_len].decode("utf-8")), start + header_len
+
+
+def decode_parent_document(value: Optional[bytes]) -> Optional[Document]:
+    """解码完整 Document；旧的 pickle 数据不会被反序列化，返回 None。"""
+    if not value:
+        return None
+    value = bytes(value)
+    if value[0] == _LEGACY_PICKLE_PREFIX:
+        logger.warning("发现旧的 pickle 格式父文档 (迁移尚未完成)，已忽略。")
+        return None
+    header, data_start = _parse_header(value)
+    body = b"".join(
+        zlib.decompress(value[data_start + off:data_start + off + clen])
+        for off, clen in header["frames"]
+    )
+    return Document(page_content=body.decode("utf-8"), metadata=header["metadata"])
+
+
+def _frames_for_range(header: dict, start: int, end: int) -> Tuple[int, int]:
+    """返回覆盖正文字节区间 [start, end) 的帧下标范围 [first, last]。"""
+    frame_size = header["frame_size"]
+    first = start // frame_size
+    last = max(first, (end - 1) // frame_size)
+    return first, min(last, len(header["frames"]) - 1)
+
+
+class ParentDocumentStore:
+    """
+    基于 langchain_key_value_stores 表的父文档存储 (仅异步接口，底层为 AsyncEngine)。
+
+    - amget / amset / amdelete / ayield_keys：与原 EncoderBackedStore 的异步接口兼容；
+    - amget_metadata：只取回 header，不传输、不解压正文；
+    - aget_body_range：只取回并解压覆盖指定 UTF-8 字节区间的帧。
+    """
+
+    def __init__(self, engine: AsyncEngine, namespace: str):
+        self.engine = engine
+        self.namespace = namespace
+
+    async def amget(self, keys: Sequence[str]) -> List[Optional[Document]]:
+        if not keys:
+            return []
+        async with self.engine.connect() as conn:
+            rows = (await conn.execute(
+                text("""
+                     SELECT key, value FROM langchain_key_value_stores
+                     WHERE namespace = :ns AND key = ANY(:keys)
+                     """),
+                {"ns": self.namespace, "keys": list(keys)}
+            )).fetchall()
+        by_key = {row[0]: row[1] for row in rows}
+        return [decode_parent_document(by_key.get(k)) for k in keys]
+
+    async def amget_metadata(self, keys: Sequence[str]) -> List[Optional[dict]]:
+        """仅获取元数据 (header)，正文不离开数据库。"""
+        if not keys:
+            return []
+        async with self.engine.connect() as conn:
+            rows = (await conn.execute(
+                text(f"""
+                     SELECT key, substring(value from {_PREFIX.size + 1} for {_SQL_HEADER_LEN}) AS header
+                     FROM langchain_key_value_stores
+                     WHERE namespace = :ns AND key = ANY(:keys) AND get_byte(value, 0) = :version
+                     """),
+                {"ns": self.namespace, "keys": list(keys), "version": FORMAT_VERSION}
+            )).fetchall()
+        by_key = {row[0]: json.loads(bytes(row[1]).decode("utf-8")) for row in rows}
+        return [by_key[k]["metadata"] if k in by_key else None for k in keys]
+
+    async def aget_body_range(self, key: str, start: int = 0, end: Optional[int] = None) -> Optional[str]:
+        """
+        读取正文 UTF-8 字节区间 [start, end) 并解码为文本
+        (区间边界落在多字节字符中间时，残缺字符会被丢弃)。
+        """
+        async with self.engine.connect() as conn:
+            row = (await conn.execute(
+                text(f"""
+                     SELECT {_SQL_HEADER_LEN} AS header_len,
+                            substring(value from {_PREFIX.size + 1} for {_SQL_HEADER_LEN}) AS header
+                     FROM langchain_key_value_stores
+                     WHERE namespace = :ns AND key = :key AND get_byte(value, 0) = :version
+                     """),
+                {"ns": self.namespace, "key": key, "version": FORMAT_VERSION}
+            )).first()
+            if row is None:
+                return None
+
+            header_len, header = row[0], json.loads(bytes(row[1]).decode("utf-8"))
+            end = header["body_len"] if end is None else min(end, header["body_len"])
+            if start >= end or not header["frames"]:
+                return ""
+
+            first, last = _frames_for_range(header, start, end)
+            data_start = _PREFIX.size + header_len
+            span_offset = header["frames"][first][0]
+            span_len = header["frames"][last][0] + header["frames"][last][1] - span_offset
+
+            span = (await conn.execute(
+                text("""
+                     SELECT substring(value from :pos for :len) FROM langchain_key_value_stores
+                     WHERE namespace = :ns AND key = :key
+                     """),
+                {"ns": self.namespace, "key": key, "pos": data_start + span_offset + 1, "len": span_len}
+            )).scalar()
+
+        span = bytes(span or b"")
+        body = b"".join(
+            zlib.decompress(span[off - span_offset:off - span_offset + clen])
+            for off, clen in header["frames"][first:last + 1]
+        )
+        base = first * header["frame_size"]
+        return body[start - base:end - base].decode("utf-8", errors="ignore")
+
+    async def amset(self, key_value_pairs: Sequence[Tuple[str, Document]]) -> None:
+        if not key_value_pairs:
+            return
+        async with self.engine.begin() as conn:
+            await conn.execute(
+                text("""
+                     INSERT INTO langchain_key_value_stores (key, value, namespace)
+                     VALUES (:key, :value, :ns)
+                     ON CONFLICT (key, namespace) DO UPDATE SET value = EXCLUDED.value
+                     """),
+                [{"key": k, "value": encode_parent_document(doc), "ns": self.namespace} for k, doc in key_value_pairs]
+            )
+
+    async def amdelete(self, keys: Sequence[str]) -> None:
+        if not keys:
+            return
+        async with self.engine.begin() as conn:
+            await conn.execute(
+                text("DELETE FROM langchain_key_value_stores WHERE namespace = :ns AND key = ANY(:keys)"),
+                {"ns": self.namespace, "keys": list(keys)}
+            )
+
+    async def ayield_keys(self, prefix: Optional[str] = None) -> AsyncIterator[str]:
+        async with self.engine.connect() as conn:
+            rows = (await conn.execute(
+                text("""
+                     SELECT key FROM langchain_key_value_stores
+                     WHERE namespace = :ns AND key LIKE :prefix
+                     """),
+                {"ns": self.namespace, "prefix": f"{prefix or ''}%"}
+            )).fetchall()
+        for row in rows:
+            yield row[0]
+
+
+async def migrate_legacy_rows(namespace: str = PARENT_STORE_NAMESPACE, batch_size: int = 200) -> int:
+    """
+    将旧的 pickle 行一次性改写为 v1 编码 (仅此迁移会执行 unpickle)。
+    按 key 做 keyset 分页，可重复执行；返回改写的行数。
+    无法反序列化的行被删除，并清空其清单版本，使下一次全量刷新重新摄取该文档。
+    """
+    import pickle
+    from database import AsyncSessionLocal
+
+    migrated, last_key = 0, ""
+    while True:
+        async with AsyncSessionLocal.begin() as session:
+            rows = (await session.execute(
+                text("""
+                     SELECT key, value FROM langchain_key_value_stores
+                     WHERE namespace = :ns AND key > :last_key AND get_byte(value, 0) = :prefix
+                     ORDER BY key
+                     LIMIT :lim
+                     """),
+                {"ns": namespace, "last_key": last_key, "prefix": _LEGACY_PICKLE_PREFIX, "lim": batch_size}
+            )).fetchall()
+            if not rows:
+                break
+
+            updates, broken = [], []
+            for key, value in rows:
+                try:
+                    updates.append(
+                        {"key": key, "value": encode_parent_document(pickle.loads(bytes(value))), "ns": namespace}
+                    )
+                except Exception as e:
+                    logger.warning(f"父文档 {key} 无法反序列化，将重新摄取: {e}")
+                    broken.append(key)
+
+            if updates:
+                await session.execute(
+                    text("UPDATE langchain_key_value_stores SET value = :value WHERE namespace = :ns AND key = :key"),
+                    updates
+                )
+            if broken:
+                await session.execute(
+                    text("DELETE FROM langchain_key_value_stores WHERE namespace = :ns AND key = ANY(:keys)"),
+                    {"ns": namespace, "keys": broken}
+                )
+                await session.execute(
+                    text("UPDATE documents SET outline_updated_at_str = NULL WHERE source_id = ANY(:keys)"),
+                    {"keys": broken}
+                )
+        migrated += len(rows)
+        last_key = rows[-1][0]
+        logger.info(f"父文档迁移进度: {migrated} 行")
+
+    return migrated
+
+
+async def ensure_legacy_rows_migrated(conn) -> None:
+    """
+    启动时调用 (由 db_init 在初始化咨询锁内执行)：迁移尚未完成时执行 migrate_legacy_rows，
+    成功后写入完成标记，之后的启动只查询该标记。
+    """
+    marker = (await conn.execute(
+        text("SELECT 1 FROM langchain_key_value_stores WHERE namespace = :ns AND key = :key"),
+        {"ns": _MIGRATION_MARKER_NAMESPACE, "key": _MIGRATION_MARKER_KEY}
+    )).first()
+    if marker:
+        return
+
+    total = await migrate_legacy_rows()
+    if total:
+        logger.info(f"父文档迁移完成，共改写 {total} 行。")
+    await conn.execute(
+        text("""
+             INSERT INTO langchain_key_value_stores (key, value, namespace)
+             VALUES (:key, NULL, :ns)
+             ON CONFLICT (key, namespace) DO NOTHING
+             """),
+        {"ns": _MIGRATION_MARKER_NAMESPACE, "key": _MIGRATION_MARKER_KEY}
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s - %(message)s")
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate":
+        total = asyncio.run(migrate_legacy_rows())
+        logger.info(f"父文档迁移完成，共改写 {total} 行。")
+    else:
+        print("usage: python docstore.py migrate")
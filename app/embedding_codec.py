@@ -0,0 +1,108 @@
+# app/embedding_codec.py
+# embedding_cache 命名空间的向量序列化格式 (版本字节 + 小端 float32/float16)
+#
+# 一次性迁移旧的 JSON 文本行:
+#     python embedding_codec.py migrate
+import asyncio
+import json
+import logging
+import struct
+import sys
+from typing import List
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# 格式版本字节
+VERSION_FLOAT32 = 0x01
+VERSION_FLOAT16 = 0x02
+
+_FORMATS = {
+    VERSION_FLOAT32: "f",
+    VERSION_FLOAT16: "e",
+}
+_VERSION_BY_NAME = {
+    "float32": VERSION_FLOAT32,
+    "float16": VERSION_FLOAT16,
+}
+
+# 旧格式 (CacheBackedEmbeddings 默认的 json.dumps) 以 '[' 开头
+_LEGACY_JSON_PREFIX = ord("[")
+
+EMBEDDING_CACHE_NAMESPACE = "embedding_cache"
+
+
+def _default_version() -> int:
+    version = _VERSION_BY_NAME.get(config.EMBEDDING_CACHE_FORMAT)
+    if version is None:
+        logger.warning(f"未知的 EMBEDDING_CACHE_FORMAT={config.EMBEDDING_CACHE_FORMAT}，回退为 float32。")
+        return VERSION_FLOAT32
+    return version
+
+
+def encode_vector(vector: List[float]) -> bytes:
+    """按 EMBEDDING_CACHE_FORMAT 编码: 1 字节版本 + 小端 packed floats。"""
+    version = _default_version()
+    return bytes([version]) + struct.pack(f"<{len(vector)}{_FORMATS[version]}", *vector)
+
+
+def decode_vector(data: bytes) -> List[float]:
+    """解码任意已知版本；兼容旧的 JSON 文本格式。"""
+    if not data:
+        raise ValueError("empty embedding payload")
+    version = data[0]
+    if version == _LEGACY_JSON_PREFIX:
+        return json.loads(data.decode("utf-8"))
+    fmt = _FORMATS.get(version)
+    if fmt is None:
+        raise ValueError(f"unknown embedding payload version: {version}")
+    item_size = struct.calcsize(f"<{fmt}")
+    count = (len(data) - 1) // item_size
+    return list(struct.unpack_from(f"<{count}{fmt}", data, 1))
+
+
+async def migrate_legacy_rows(batch_size: int = 500) -> int:
+    """
+    将 embedding_cache 中旧的 JSON 文本行改写为当前二进制格式。
+    按 key 做 keyset 分页，可重复执行；返回改写的行数。
+    """
+    from sqlalchemy import text
+    from database import AsyncSessionLocal
+
+    migrated, last_key = 0, ""
+    while True:
+        async with AsyncSessionLocal.begin() as session:
+            rows = (await session.execute(
+                text("""
+                     SELECT key, value FROM langchain_key_value_stores
+                     WHERE namespace = :ns AND key > :last_key AND get_byte(value, 0) = :prefix
+                     ORDER BY key
+                     LIMIT :lim
+                     """),
+                {"ns": EMBEDDING_CACHE_NAMESPACE, "last_key": last_key, "prefix": _LEGACY_JSON_PREFIX, "lim": batch_size}
+            )).fetchall()
+            if not rows:
+                break
+
+            await session.execute(
+                text("UPDATE langchain_key_value_stores SET value = :value WHERE namespace = :ns AND key = :key"),
+                [
+                    {"key": key, "value": encode_vector(decode_vector(bytes(value))), "ns": EMBEDDING_CACHE_NAMESPACE}
+                    for key, value in rows
+                ]
+            )
+        migrated += len(rows)
+        last_key = rows[-1][0]
+        logger.info(f"embedding_cache 迁移进度: {migrated} 行")
+
+    return migrated
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s - %(message)s")
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate":
+        total = asyncio.run(migrate_legacy_rows())
+        logger.info(f"embedding_cache 迁移完成，共改写 {total} 行。")
+    else:
+        print("usage: python embedding_codec.py migrate")
@@ -11,6 +11,11 @@ PY
   export SECRET_KEY
 fi
 
+# APP_ROLE=worker 时只运行后台摄取 worker (任务处理器、延时任务调度器)，不启动 Web 服务
+if [ "${APP_ROLE}" = "worker" ]; then
+  exec python -m worker
+fi
+
 # 可选：允许通过环境变量覆盖端口和 worker 数
 UVICORN_PORT="${PORT:-8080}"
 UVICORN_WORKERS="${UVICORN_WORKERS:-2}"
@@ -0,0 +1,200 @@
+# app/hybrid_retriever.py
+# 混合检索：向量检索 (HNSW) 与词法检索 (pg_trgm GIN) 并行执行，按倒数排名融合 (RRF)
+import asyncio
+import logging
+import re
+from typing import Any, Dict, List, Optional
+
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from pydantic import PrivateAttr
+from sqlalchemy import text
+
+from database import AsyncSessionLocal, lexical_cjk_supported
+
+logger = logging.getLogger(__name__)
+
+# 词法检索返回的列 (与向量检索的 metadata_columns 一致)
+_METADATA_COLUMNS = (
+    "source_id",
+    "title",
+    "outline_updated_at_str",
+    "url",
+    "content_hash",
+    "chunk_index",
+    "token_count",
+)
+
+# 标识符、错误码、版本号等 (英文/数字及常见连接符)
+_ASCII_TERM_RE = re.compile(r"[A-Za-z0-9_][A-Za-z0-9_.\-/:]*[A-Za-z0-9_]|[A-Za-z0-9_]")
+_CJK_RUN_RE = re.compile(r"[一-鿿]+")
+# pg_trgm 以三字符为单位建索引，短于 3 的词无法走 GIN 索引
+_MIN_TERM_LEN = 3
+_CJK_NGRAM = 3
+_MAX_TERMS = 16
+_STOPWORDS = {
+    "the", "and", "for", "are", "but", "not", "you", "all", "any", "can", "how", "what", "why",
+    "when", "where", "which", "who", "with", "this", "that", "from", "have", "does", "into",
+}
+
+
+def lexical_terms(query: str) -> List[str]:
+    """
+    提取词法检索的词项 (按出现顺序去重)：
+    英文/数字按整词 (保留 E1234、v2.3.1、foo_bar 之类的标识符)，
+    中文无分词，按连续汉字串的三字 n-gram。
+    数据库区域设置 (如 C/POSIX) 使 pg_trgm 无法从汉字提取 trigram 时不生成中文词项：
+    这类 ILIKE 用不上 GIN 索引，每次查询都是全表扫描。
+    """
+    terms: List[str] = []
+    for token in _ASCII_TERM_RE.findall(query or ""):
+        if len(token) >= _MIN_TERM_LEN and token.lower() not in _STOPWORDS:
+            terms.append(token)
+    for run in (_CJK_RUN_RE.findall(query or "") if lexical_cjk_supported() else []):
+        if len(run) < _CJK_NGRAM:
+            continue
+        terms.extend(run[i:i + _CJK_NGRAM] for i in range(len(run) - _CJK_NGRAM + 1))
+
+    seen, unique = set(), []
+    for term in terms:
+        key = term.lower()
+        if key not in seen:
+            seen.add(key)
+            unique.append(term)
+    return unique[:_MAX_TERMS]
+
+
+def _like_pattern(term: str) -> str:
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+async def lexical_search(query: str, k: int) -> List[Document]:
+    """
+    以 ILIKE 子串匹配检索块 (由 pg_trgm GIN 索引加速)。
+    得分为命中词项的长度之和：越长、越具体的词项 (如完整错误码) 权重越高。
+    """
+    terms = lexical_terms(query)
+    if not terms or k <= 0:
+        return []
+
+    params: Dict[str, Any] = {"k": k}
+    conditions, weights = [], []
+    for i, term in enumerate(terms):
+        params[f"p{i}"] = _like_pattern(term)
+        conditions.append(f"content ILIKE :p{i}")
+        weights.append(f"CASE WHEN content ILIKE :p{i} THEN {len(term)} ELSE 0 END")
+
+    columns = ", ".join(_METADATA_COLUMNS)
+    sql = f"""
+        SELECT langchain_id, content, {columns}, ({" + ".join(weights)}) AS lexical_score
+        FROM langchain_pg_embedding
+        WHERE {" OR ".join(conditions)}
+        ORDER BY lexical_score DESC, chunk_index
+        LIMIT :k
+    """
+    async with AsyncSessionLocal() as session:
+        rows = (await session.execute(text(sql), params)).mappings().all()
+
+    return [
+        Document(
+            id=str(row["langchain_id"]),
+            page_content=row["content"],
+            metadata={col: row[col] for col in _METADATA_COLUMNS},
+        )
+        for row in rows
+    ]
+
+
+def _doc_key(doc: Document) -> Any:
+    if doc.id:
+        return str(doc.id)
+    return doc.metadata.get("source_id"), doc.metadata.get("chunk_index"), doc.metadata.get("content_hash")
+
+
+def reciprocal_rank_fusion(ranked_lists: List[List[Document]], weights: List[float], rrf_k: int) -> List[Document]:
+    """RRF: score(d) = Σ w_i / (rrf_k + rank_i(d))，rank 从 1 开始。"""
+    scores: Dict[Any, float] = {}
+    docs: Dict[Any, Document] = {}
+    for ranked, weight in zip(ranked_lists, weights):
+        for rank, doc in enumerate(ranked, start=1):
+            key = _doc_key(doc)
+            scores[key] = scores.get(key, 0.0) + weight / (rrf_k + rank)
+            docs.setdefault(key, doc)
+    ordered = sorted(scores, key=lambda key: scores[key], reverse=True)
+    fused = []
+    for key in ordered:
+        doc = docs[key]
+        doc.metadata["rrf_score"] = scores[key]
+        fused.append(doc)
+    return fused
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    向量检索与词法检索并行执行并做 RRF 融合，返回前 top_k 个块。
+    词法检索失败时退化为纯向量检索。
+    """
+
+    vector_store: Any
+    vector_k: int
+    lexical_k: int
+    lexical_weight: float = 1.0
+    rrf_k: int = 60
+    top_k: int
+
+    # 首次异步调用所在的事件循环 (AsyncEngine 的连接绑定在该循环上)，供同步调用转发
+    _loop: Optional[asyncio.AbstractEventLoop] = PrivateAttr(default=None)
+
+    async def _search(self, query: str) -> List[Document]:
+        if not lexical_terms(query):
+            # 没有可索引的词项 (如纯中文查询而数据库无法索引汉字)：只做向量检索
+            vector_docs = await self.vector_store.asimilarity_search(query, k=self.vector_k)
+            return vector_docs[:self.top_k]
+
+        vector_docs, lexical_docs = await asyncio.gather(
+            self.vector_store.asimilarity_search(query, k=self.vector_k),
+            lexical_search(query, self.lexical_k),
+            return_exceptions=True,
+        )
+        if isinstance(vector_docs, BaseException):
+            raise vector_docs
+        if isinstance(lexical_docs, BaseException):
+            logger.warning(f"Lexical search failed, using vector results only: {lexical_docs}")
+            lexical_docs = []
+
+        fused = reciprocal_rank_fusion(
+            [vector_docs, lexical_docs], [1.0, self.lexical_weight], self.rrf_k
+        )
+        logger.debug(
+            f"Hybrid retrieval: {len(vector_docs)} vector + {len(lexical_docs)} lexical -> "
+            f"{len(fused)} fused, keeping {self.top_k}."
+        )
+        return fused[:self.top_k]
+
+    async def _aget_relevant_documents(
+            self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        return await self._search(query)
+
+    def _get_relevant_documents(
+            self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        """
+        同步调用 (如从线程池中调用)：转发到拥有数据库连接的事件循环上执行并等待结果；
+        尚无运行中的事件循环时 (如脚本) 新建一个。
+        """
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is not None:
+            # 在事件循环线程内同步等待会造成死锁
+            raise RuntimeError("HybridRetriever.invoke() called from a running event loop; use ainvoke().")
+
+        if self._loop is not None and self._loop.is_running():
+            return asyncio.run_coroutine_threadsafe(self._search(query), self._loop).result()
+        return asyncio.run(self._search(query))
@@ -0,0 +1,125 @@
+# app/ingest_pipeline.py
+# 由有界 asyncio.Queue 串联的多阶段流水线 (fetch -> split -> embed -> write 等)
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 阶段之间传递的结束信号
+_STOP = object()
+
+
+@dataclass
+class Stage:
+    """
+    流水线中的一个阶段。
+    handler 接收一批 item (长度 <= batch_size)，返回要传给下一阶段的 item 列表；
+    未返回的 item 视为被本阶段丢弃 (例如内容为空)。
+    """
+    name: str
+    handler: Callable[[List[Any]], Awaitable[Optional[List[Any]]]]
+    concurrency: int = 1
+    queue_depth: int = 16
+    batch_size: int = 1
+
+
+@dataclass
+class StageStats:
+    name: str
+    items_in: int = 0
+    items_out: int = 0
+    errors: int = 0
+    busy_seconds: float = 0.0
+    started_at: float = field(default_factory=time.perf_counter)
+    finished_at: float = 0.0
+
+    def summary(self) -> str:
+        wall = max((self.finished_at or time.perf_counter()) - self.started_at, 1e-6)
+        return (
+            f"stage={self.name} in={self.items_in} out={self.items_out} errors={self.errors} "
+            f"busy={self.busy_seconds:.2f}s wall={wall:.2f}s throughput={self.items_in / wall:.1f}/s"
+        )
+
+
+async def run_pipeline(
+        items: Iterable[Any],
+        stages: List[Stage],
+        on_error: Callable[[Any, Exception], None],
+        label: str = "pipeline",
+) -> List[Any]:
+    """
+    运行流水线并返回最后一个阶段输出的 item。
+    每个阶段的输入队列都有上限 (queue_depth)，下游变慢时上游自动阻塞 (背压)，
+    因此内存占用由队列深度决定，而不是由输入总量决定。
+    单个 item 的异常交给 on_error，不会中断整条流水线。
+    """
+    if not stages:
+        return list(items)
+
+    queues = [asyncio.Queue(maxsize=max(1, s.queue_depth)) for s in stages]
+    stats = [StageStats(name=s.name) for s in stages]
+    completed: List[Any] = []
+
+    async def _feed():
+        for item in items:
+            await queues[0].put(item)
+        for _ in range(max(1, stages[0].concurrency)):
+            await queues[0].put(_STOP)
+
+    async def _worker(idx: int):
+        stage, inq, stat = stages[idx], queues[idx], stats[idx]
+        outq = queues[idx + 1] if idx + 1 < len(stages) else None
+
+        while True:
+            item = await inq.get()
+            if item is _STOP:
+                return
+
+            # 队列中已有积压时，凑满一批再交给 handler
+            batch, stop_after = [item], False
+            while len(batch) < max(1, stage.batch_size):
+                try:
+                    nxt = inq.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                if nxt is _STOP:
+                    stop_after = True
+                    break
+                batch.append(nxt)
+
+            stat.items_in += len(batch)
+            t0 = time.perf_counter()
+            try:
+                results = await stage.handler(batch) or []
+            except Exception as e:
+                stat.errors += len(batch)
+                for failed in batch:
+                    on_error(failed, e)
+                results = []
+            stat.busy_seconds += time.perf_counter() - t0
+            stat.items_out += len(results)
+
+            for result in results:
+                if outq is not None:
+                    await outq.put(result)
+                else:
+                    completed.append(result)
+
+            if stop_after:
+                return
+
+    async def _run_stage(idx: int):
+        await asyncio.gather(*(_worker(idx) for _ in range(max(1, stages[idx].concurrency))))
+        stats[idx].finished_at = time.perf_counter()
+        if idx + 1 < len(stages):
+            for _ in range(max(1, stages[idx + 1].concurrency)):
+                await queues[idx + 1].put(_STOP)
+
+    await asyncio.gather(_feed(), *(_run_stage(i) for i in range(len(stages))))
+
+    for stat in stats:
+        logger.info(f"[{label}] {stat.summary()}")
+    return completed
@@ -1,23 +1,32 @@
 # app/llm_services.py
+import asyncio
 import hashlib
 import logging
-from typing import Sequence, Any, List, Tuple
+import unicodedata
+from typing import Sequence, Any, List, Tuple, Optional, Iterator, AsyncIterator
 
 import httpx
+import openai
 import tiktoken
 from httpx import Response
 from httpx_retries import RetryTransport, Retry
 from langchain.embeddings.cache import CacheBackedEmbeddings
+from langchain.storage import EncoderBackedStore
 from langchain_community.cache import AsyncRedisCache
 from langchain_community.storage.sql import SQLStore, LangchainKeyValueStores
 from langchain_core.documents import BaseDocumentCompressor
 from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.stores import ByteStore
 from langchain_siliconflow.chat_models import ChatSiliconFlow
 from langchain_siliconflow.embeddings import SiliconFlowEmbeddings
 from sqlalchemy.dialects.postgresql import insert as pg_insert
 
 import config
-from database import async_engine, redis_client
+import embedding_codec
+from database import async_engine, redis_client, redis_binary_client
+from lru_cache import ByteLRU
+from rate_limiter import RateLimitedTransport, rate_limited_client
 
 logger = logging.getLogger(__name__)
 
@@ -107,14 +116,333 @@ class IdempotentSQLStore(SQLStore):
             logger.warning(f"IdempotentSQLStore mset (sync) failed (non-fatal): {e}", exc_info=True)
 
 
+class TieredByteStore(ByteStore):
+    """
+    Embedding 缓存的多级前置层：进程内 LRU -> Redis (可选) -> 底层 SQLStore。
+
+    - 读穿透 (read-through)：逐级查找，命中后回填到更快的层；
+    - 写穿透 (write-through)：写入同时落到所有层；
+    - 分层命中/未命中计数，可通过 stats() 查看，并定期写入日志。
+    """
+
+    _LOG_EVERY = 5000
+
+    def __init__(self, backend: ByteStore, lru: ByteLRU, redis_=None, redis_ttl: int = 0, redis_prefix: str = "kv"):
+        self.backend = backend
+        self.lru = lru
+        self.redis = redis_ if redis_ttl > 0 else None
+        self.redis_ttl = redis_ttl
+        self.redis_prefix = redis_prefix
+        self.counters = {"lru_hits": 0, "redis_hits": 0, "db_hits": 0, "misses": 0}
+        self._lookups_since_log = 0
+
+    def _redis_key(self, key: str) -> str:
+        return f"{self.redis_prefix}:{key}"
+
+    def stats(self) -> dict:
+        return {**self.counters, "lru": self.lru.stats()}
+
+    def _count(self, name: str, n: int) -> None:
+        self.counters[name] += n
+        self._lookups_since_log += n
+        if self._lookups_since_log >= self._LOG_EVERY:
+            self._lookups_since_log = 0
+            logger.info(f"TieredByteStore stats: {self.counters}")
+
+    async def amget(self, keys: Sequence[str]) -> List[Optional[bytes]]:
+        results: List[Optional[bytes]] = [self.lru.get(k) for k in keys]
+        missing = [i for i, v in enumerate(results) if v is None]
+        self._count("lru_hits", len(keys) - len(missing))
+
+        if missing and self.redis is not None:
+            try:
+                cached = await self.redis.mget([self._redis_key(keys[i]) for i in missing])
+                still_missing = []
+                for i, value in zip(missing, cached):
+                    if value is None:
+                        still_missing.append(i)
+                    else:
+                        results[i] = value
+                        self.lru.set(keys[i], value)
+                self._count("redis_hits", len(missing) - len(still_missing))
+                missing = still_missing
+            except Exception as e:
+                logger.warning(f"TieredByteStore Redis mget failed (non-fatal): {e}")
+
+        if missing:
+            db_values = await self.backend.amget([keys[i] for i in missing])
+            backfill = []
+            for i, value in zip(missing, db_values):
+                if value is not None:
+                    results[i] = value
+                    self.lru.set(keys[i], value)
+                    backfill.append((keys[i], value))
+            self._count("db_hits", len(backfill))
+            self._count("misses", len(missing) - len(backfill))
+            if backfill:
+                await self._redis_set(backfill)
+
+        return results
+
+    async def _redis_set(self, key_value_pairs: Sequence[Tuple[str, bytes]]) -> None:
+        if self.redis is None:
+            return
+        try:
+            p = self.redis.pipeline(transaction=False)
+            for k, v in key_value_pairs:
+                p.set(self._redis_key(k), v, ex=self.redis_ttl)
+            await p.execute()
+        except Exception as e:
+            logger.warning(f"TieredByteStore Redis set failed (non-fatal): {e}")
+
+    async def amset(self, key_value_pairs: Sequence[Tuple[str, bytes]]) -> None:
+        for k, v in key_value_pairs:
+            self.lru.set(k, v)
+        await self._redis_set(key_value_pairs)
+        await self.backend.amset(key_value_pairs)
+
+    async def amdelete(self, keys: Sequence[str]) -> None:
+        for k in keys:
+            self.lru.delete(k)
+        if self.redis is not None:
+            try:
+                await self.redis.delete(*[self._redis_key(k) for k in keys])
+            except Exception as e:
+                logger.warning(f"TieredByteStore Redis delete failed (non-fatal): {e}")
+        await self.backend.amdelete(keys)
+
+    async def ayield_keys(self, prefix: Optional[str] = None) -> AsyncIterator[str]:
+        async for key in self.backend.ayield_keys(prefix=prefix):
+            yield key
+
+    # 同步接口只经过 LRU 与底层存储 (不应在 async 应用中调用)
+    def mget(self, keys: Sequence[str]) -> List[Optional[bytes]]:
+        results = [self.lru.get(k) for k in keys]
+        missing = [i for i, v in enumerate(results) if v is None]
+        if missing:
+            for i, value in zip(missing, self.backend.mget([keys[i] for i in missing])):
+                if value is not None:
+                    results[i] = value
+                    self.lru.set(keys[i], value)
+        return results
+
+    def mset(self, key_value_pairs: Sequence[Tuple[str, bytes]]) -> None:
+        for k, v in key_value_pairs:
+            self.lru.set(k, v)
+        self.backend.mset(key_value_pairs)
+
+    def mdelete(self, keys: Sequence[str]) -> None:
+        for k in keys:
+            self.lru.delete(k)
+        self.backend.mdelete(keys)
+
+    def yield_keys(self, prefix: Optional[str] = None) -> Iterator[str]:
+        yield from self.backend.yield_keys(prefix=prefix)
+
+
 # 预加载 tiktoken tokenizer
+_tokenizer = None
 try:
     logger.info("Pre-caching tiktoken tokenizer model (cl100k_base)...")
-    tiktoken.get_encoding("cl100k_base")
+    _tokenizer = tiktoken.get_encoding("cl100k_base")
     logger.info("Tiktoken model (cl100k_base) is cached.")
 except Exception as e:
     logger.warning("Failed to pre-cache tiktoken model: %s", e)
 
+
+def count_tokens(text_value: str) -> int:
+    """用 cl100k_base 估算 token 数；tokenizer 不可用时按字符数保守估计。"""
+    if _tokenizer is None:
+        return len(text_value)
+    return len(_tokenizer.encode(text_value, disallowed_special=()))
+
+
+# 400 响应中表示输入过长的提示 (各 OpenAI 兼容服务措辞不一)
+_INPUT_TOO_LARGE_HINTS = ("too long", "too large", "exceed", "context length")
+
+
+def _is_input_too_large(exc: Exception) -> bool:
+    """仅请求体/token 超限 (413，或提示输入过长的 400) 才值得拆分重试；429/401/超时等应立即抛出。"""
+    if isinstance(exc, openai.APIStatusError):
+        status, message = exc.status_code, str(exc.message)
+    elif isinstance(exc, httpx.HTTPStatusError):
+        status, message = exc.response.status_code, exc.response.text
+    else:
+        return False
+    if status == 413:
+        return True
+    return status == 400 and any(hint in message.lower() for hint in _INPUT_TOO_LARGE_HINTS)
+
+
+class TokenBatchedEmbeddings(Embeddings):
+    """
+    按 token 预算打包请求的 Embedding 包装器。
+
+    - 将文本按 cl100k_base token 数贪心装箱，每个请求尽量接近
+      EMBEDDING_MAX_BATCH_TOKENS，且条目数不超过 EMBEDDING_MAX_BATCH_SIZE；
+    - 多个请求以 EMBEDDING_REQUEST_CONCURRENCY 为上限并发发送；
+    - 子批次因超限 (413，或提示输入过长的 400) 失败时二分拆分后重试，直到单条仍失败才抛出；
+      其他错误 (429、401、超时等) 直接抛出，避免在限流时放大请求数。
+    """
+
+    def __init__(self, base: Embeddings, max_batch_tokens: int, max_batch_size: int, concurrency: int):
+        self.base = base
+        self.max_batch_tokens = max(1, max_batch_tokens)
+        self.max_batch_size = max(1, max_batch_size)
+        self._semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    def _pack(self, texts: List[str]) -> List[List[int]]:
+        """返回按 token 预算分组后的下标列表。"""
+        batches, current, current_tokens = [], [], 0
+        for i, t in enumerate(texts):
+            n = count_tokens(t)
+            if current and (current_tokens + n > self.max_batch_tokens or len(current) >= self.max_batch_size):
+                batches.append(current)
+                current, current_tokens = [], 0
+            current.append(i)
+            current_tokens += n
+        if current:
+            batches.append(current)
+        return batches
+
+    async def _aembed_with_split(self, texts: List[str]) -> List[List[float]]:
+        try:
+            async with self._semaphore:
+                return await self.base.aembed_documents(texts)
+        except Exception as e:
+            if len(texts) <= 1 or not _is_input_too_large(e):
+                raise
+            mid = len(texts) // 2
+            logger.warning(f"Embedding 子批次 ({len(texts)} 条) 超限，拆分重试: {e}")
+            left, right = await asyncio.gather(
+                self._aembed_with_split(texts[:mid]),
+                self._aembed_with_split(texts[mid:]),
+            )
+            return left + right
+
+    def _embed_with_split(self, texts: List[str]) -> List[List[float]]:
+        try:
+            return self.base.embed_documents(texts)
+        except Exception as e:
+            if len(texts) <= 1 or not _is_input_too_large(e):
+                raise
+            mid = len(texts) // 2
+            logger.warning(f"Embedding 子批次 ({len(texts)} 条) 超限，拆分重试: {e}")
+            return self._embed_with_split(texts[:mid]) + self._embed_with_split(texts[mid:])
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        batches = self._pack(texts)
+        results = await asyncio.gather(*(
+            self._aembed_with_split([texts[i] for i in batch]) for batch in batches
+        ))
+        vectors: List[List[float]] = [[] for _ in texts]
+        for batch, batch_vectors in zip(batches, results):
+            for i, vector in zip(batch, batch_vectors):
+                vectors[i] = vector
+        logger.debug(f"Embedded {len(texts)} texts in {len(batches)} requests.")
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors: List[List[float]] = [[] for _ in texts]
+        for batch in self._pack(texts):
+            for i, vector in zip(batch, self._embed_with_split([texts[i] for i in batch])):
+                vectors[i] = vector
+        return vectors
+
+    async def aembed_query(self, text_value: str) -> List[float]:
+        return await self.base.aembed_query(text_value)
+
+    def embed_query(self, text_value: str) -> List[float]:
+        return self.base.embed_query(text_value)
+
+
+class QueryCachedEmbeddings(Embeddings):
+    """
+    查询向量缓存包装器 (文档向量直接委托给底层)。
+
+    - 以规范化后的查询文本 (NFKC、折叠空白) 为键：进程内 LRU -> Redis (可选)；
+    - single-flight：同一时刻相同查询只发出一个 Embedding 请求，其余调用共享其结果；
+    - 未命中时对规范化文本求向量，保证缓存值与键一致。
+    """
+
+    def __init__(self, base: Embeddings, lru: ByteLRU, redis_=None, redis_ttl: int = 0,
+                 redis_prefix: str = "kv:query_embedding"):
+        self.base = base
+        self.lru = lru
+        self.redis = redis_ if redis_ttl > 0 else None
+        self.redis_ttl = redis_ttl
+        self.redis_prefix = redis_prefix
+        self.counters = {"lru_hits": 0, "redis_hits": 0, "shared": 0, "misses": 0}
+        self._inflight: dict = {}
+
+    @staticmethod
+    def normalize(text_value: str) -> str:
+        return " ".join(unicodedata.normalize("NFKC", text_value or "").split())
+
+    def stats(self) -> dict:
+        return {**self.counters, "lru": self.lru.stats(), "inflight": len(self._inflight)}
+
+    async def _lookup_or_embed(self, key: str, normalized: str) -> List[float]:
+        if self.redis is not None:
+            try:
+                cached = await self.redis.get(f"{self.redis_prefix}:{key}")
+                if cached is not None:
+                    self.counters["redis_hits"] += 1
+                    self.lru.set(key, cached)
+                    return embedding_codec.decode_vector(cached)
+            except Exception as e:
+                logger.warning(f"QueryCachedEmbeddings Redis get failed (non-fatal): {e}")
+
+        self.counters["misses"] += 1
+        vector = await self.base.aembed_query(normalized)
+        encoded = embedding_codec.encode_vector(vector)
+        self.lru.set(key, encoded)
+        if self.redis is not None:
+            try:
+                await self.redis.set(f"{self.redis_prefix}:{key}", encoded, ex=self.redis_ttl)
+            except Exception as e:
+                logger.warning(f"QueryCachedEmbeddings Redis set failed (non-fatal): {e}")
+        return vector
+
+    async def aembed_query(self, text_value: str) -> List[float]:
+        normalized = self.normalize(text_value)
+        key = _sha256_encoder(f"query:{normalized}")
+
+        cached = self.lru.get(key)
+        if cached is not None:
+            self.counters["lru_hits"] += 1
+            return embedding_codec.decode_vector(cached)
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.counters["shared"] += 1
+        else:
+            # 共享请求在独立任务中执行，不属于任何一个调用方：
+            # 发起者被取消 (如对话客户端断开) 时，其余等待者照常得到结果
+            task = asyncio.create_task(self._lookup_or_embed(key, normalized))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._release_inflight(key, t))
+        # shield：某个等待者被取消只取消它自己的等待
+        return list(await asyncio.shield(task))
+
+    def _release_inflight(self, key: str, task: "asyncio.Task") -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # 所有等待者都已取消时避免 "exception was never retrieved"
+
+    def embed_query(self, text_value: str) -> List[float]:
+        return self.base.embed_query(self.normalize(text_value))
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self.base.aembed_documents(texts)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.base.embed_documents(texts)
+
+
 _cache_prefix = f"emb:{config.EMBEDDING_MODEL}"
 
 
@@ -127,7 +455,7 @@ def _sha256_encoder(s: str) -> str:
 
 
 def _create_retry_client() -> httpx.AsyncClient:
-    """创建带 httpx-retries 的 AsyncClient"""
+    """创建带 httpx-retries 与自适应限流的 AsyncClient"""
     retry_strategy = Retry(
         total=3,
         backoff_factor=0.5,
@@ -137,7 +465,7 @@ def _create_retry_client() -> httpx.AsyncClient:
     base_transport = httpx.AsyncHTTPTransport()
     transport = RetryTransport(
         retry=retry_strategy,
-        transport=base_transport
+        transport=RateLimitedTransport(base_transport)
     )
     client = httpx.AsyncClient(transport=transport)
     return client
@@ -150,7 +478,9 @@ def _create_retry_client() -> httpx.AsyncClient:
 # 'model' 参数已移除，它将在 api.py 中通过 .bind() 动态提供
 llm = ChatSiliconFlow(
     api_key=config.SILICONFLOW_API_KEY,
-    base_url=f"{config.SILICONFLOW_BASE_URL.rstrip('/')}/v1"
+    base_url=f"{config.SILICONFLOW_BASE_URL.rstrip('/')}/v1",
+    # 与 Reranker / Embedding 共享同一主机的限流器 (对话请求走交互式优先通道)
+    http_async_client=rate_limited_client()
 )
 
 # [--- 修复：移除 llm_thinking 实例 ---]
@@ -205,31 +535,83 @@ _base_embeddings = SiliconFlowEmbeddings(
     # 正确的 'client' 和 'async_client'
 ) # type: ignore
 
+# 用经由限流器的 http_client 重建 async_client (验证器创建的默认客户端不经过限流)。
+# SiliconFlowEmbeddings 调用 async_client.embeddings.create(...)，因此这里赋值根客户端；
+# base_url 与验证器的处理一致：只在缺少 /v1 时追加。
+_embeddings_async_base_url = _siliconflow_base_url_for_embeddings
+if not _embeddings_async_base_url.endswith("/v1"):
+    _embeddings_async_base_url = f"{_embeddings_async_base_url}/v1"
+try:
+    _base_embeddings.async_client = openai.AsyncOpenAI(
+        api_key=_siliconflow_api_key,
+        base_url=_embeddings_async_base_url,
+        http_client=rate_limited_client(),
+    )
+except Exception as e:
+    logger.warning(f"无法为 Embedding 客户端启用限流器，将使用默认客户端: {e}")
+
+# 按 token 预算打包并发请求 (缓存未命中的文本才会到达这里)
+_batched_embeddings = TokenBatchedEmbeddings(
+    _base_embeddings,
+    max_batch_tokens=config.EMBEDDING_MAX_BATCH_TOKENS,
+    max_batch_size=config.EMBEDDING_MAX_BATCH_SIZE,
+    concurrency=config.EMBEDDING_REQUEST_CONCURRENCY,
+)
+
 store = None
 try:
     if not async_engine:
         raise ValueError("database.py 中的 async_engine 不可用")
 
-    store = IdempotentSQLStore(
+    sql_store = IdempotentSQLStore(
         engine=async_engine,
-        namespace="embedding_cache",
+        namespace=embedding_codec.EMBEDDING_CACHE_NAMESPACE,
     )
 
-    embeddings_model = CacheBackedEmbeddings.from_bytes_store(
-        _base_embeddings,
-        store,
-        key_encoder=_sha256_encoder
+    # 进程内 LRU + Redis 前置层：热 embedding 查询基本不再访问 Postgres
+    store = TieredByteStore(
+        backend=sql_store,
+        lru=ByteLRU(config.EMBEDDING_CACHE_LRU_MAX_BYTES),
+        redis_=redis_binary_client,
+        redis_ttl=config.EMBEDDING_CACHE_REDIS_TTL,
+        redis_prefix="kv:embedding_cache",
     )
 
-    embeddings_model.key_encoder = _sha256_encoder
+    # 向量以版本字节 + packed float32/float16 存储 (兼容读取旧的 JSON 文本)
+    document_embedding_store = EncoderBackedStore[str, List[float]](
+        store=store,
+        key_encoder=_sha256_encoder,
+        value_serializer=embedding_codec.encode_vector,
+        value_deserializer=embedding_codec.decode_vector,
+    )
 
-    logger.info("LangChain Embedding 缓存已启用 (SQLStore-Async, SHA256+Prefix, namespace='embedding_cache')")
+    embeddings_model = CacheBackedEmbeddings(
+        _batched_embeddings,
+        document_embedding_store,
+    )
+
+    logger.info(
+        f"LangChain Embedding 缓存已启用 (LRU -> Redis -> SQLStore-Async, SHA256+Prefix, "
+        f"namespace='embedding_cache', format={config.EMBEDDING_CACHE_FORMAT})"
+    )
 
 except Exception as e:
     logger.warning("无法为 LangChain 缓存配置 SQLStore: %s", e, exc_info=True)
-    embeddings_model = _base_embeddings
+    embeddings_model = _batched_embeddings
     logger.info("LangChain Embedding 缓存未启用 (SQLStore 初始化失败)")
 
+# 查询向量缓存 + single-flight (CacheBackedEmbeddings 只缓存文档向量)
+embeddings_model = QueryCachedEmbeddings(
+    embeddings_model,
+    lru=ByteLRU(config.QUERY_EMBEDDING_CACHE_LRU_MAX_BYTES),
+    redis_=redis_binary_client,
+    redis_ttl=config.QUERY_EMBEDDING_CACHE_REDIS_TTL,
+)
+logger.info(
+    f"查询向量缓存已启用 (LRU {config.QUERY_EMBEDDING_CACHE_LRU_MAX_BYTES} bytes, "
+    f"Redis TTL={config.QUERY_EMBEDDING_CACHE_REDIS_TTL}s, single-flight)。"
+)
+
 
 # --- 重排模型 (Reranker) ---
 class SiliconFlowReranker(BaseDocumentCompressor):
@@ -0,0 +1,69 @@
+# app/lru_cache.py
+# 进程内、按字节数限制容量的 LRU 缓存 (非线程安全，仅供单个事件循环使用)
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+def _default_sizeof(value: Any) -> int:
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    return 1
+
+
+class ByteLRU:
+    """
+    以字节数 (由 sizeof 估算) 为上限的 LRU。
+    超出 max_bytes 时从最久未使用的条目开始淘汰；单个超过上限的条目不会被缓存。
+    """
+
+    def __init__(self, max_bytes: int, sizeof: Callable[[Any], int] = _default_sizeof):
+        self.max_bytes = max(0, max_bytes)
+        self.sizeof = sizeof
+        self._data: "OrderedDict[Hashable, tuple[Any, int]]" = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        size = self.sizeof(value)
+        self.delete(key)
+        if size > self.max_bytes:
+            return
+        self._data[key] = (value, size)
+        self.current_bytes += size
+        while self.current_bytes > self.max_bytes and self._data:
+            _, (_, evicted_size) = self._data.popitem(last=False)
+            self.current_bytes -= evicted_size
+
+    def delete(self, key: Hashable) -> None:
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.current_bytes -= entry[1]
+
+    def clear(self) -> None:
+        self._data.clear()
+        self.current_bytes = 0
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._data),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -1,14 +1,11 @@
 # app/main.py
 import asyncio
-import json
 import logging
 import os
 import sys
-import time
 from contextlib import asynccontextmanager
 from datetime import timedelta
 
-import redis.asyncio as redis
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
@@ -17,14 +14,18 @@ from uvicorn.middleware.proxy_headers import ProxyHeadersMiddleware
 
 # 导入配置
 import config
-# 导入异步任务
-import rag
+# 导入后台子系统 (任务处理器、延时任务调度器)
+from worker import start_background_workers, stop_background_workers
 # 导入新的异步蓝图 (APIRouter)
 from blueprints.api import api_router
 from blueprints.auth import auth_router
 from blueprints.views import views_router
 # 导入异步数据库
-from database import db_init, redis_client, async_engine
+from database import db_init, redis_client, redis_binary_client, async_engine
+# 导入 Outline 共享 HTTP 客户端
+from outline_client import init_outline_client, close_outline_client
+# 导入父文档缓存失效监听器
+from parent_cache import invalidation_listener
 
 # --- 2. 配置日志 (在 Gunicorn/Uvicorn 启动时) ---
 logging.basicConfig(
@@ -36,56 +37,7 @@ logging.getLogger("uvicorn.access").setLevel(logging.ERROR) # 移除访问日志
 logger = logging.getLogger("main")
 
 # --- 6. 后台任务 (异步) ---
-
-async def task_worker():
-    """后台任务处理器，从 Redis 队列中消费任务。"""
-    logger.info("后台任务处理器已启动 (异步)。")
-    while True:
-        try:
-            _queue, task_json = await redis_client.brpop("task_queue", timeout=0)
-            task_data = json.loads(task_json)
-            task_name = task_data.get("task")
-            logger.info("接收到新任务: %s", task_name)
-
-            if task_name == "refresh_all":
-                await rag.refresh_all_task()
-            elif task_name == "process_doc_batch":
-                await rag.process_doc_batch_task(task_data.get("doc_ids", []))
-            else:
-                logger.warning("未知任务类型: %s", task_name)
-
-        except (redis.ConnectionError, asyncio.CancelledError) as e:
-            logger.error("Redis 连接错误或任务取消，任务处理器暂停5秒: %s", e)
-            await asyncio.sleep(5)
-        except json.JSONDecodeError as e:
-            logger.error(f"任务队列 JSON 解析失败'): {e}")
-        except Exception as e:
-            logger.exception("任务处理器发生未知错误: %s", e)
-            await asyncio.sleep(1)
-
-
-async def webhook_watcher():
-    """后台 Webhook 计时器监视器 (异步)。"""
-    logger.info("Webhook 监视器已启动 (异步)。")
-    while True:
-        try:
-            due_time_str = await redis_client.get("webhook:refresh_timer_due")
-            if due_time_str:
-                due_time = int(due_time_str)
-                if time.time() > due_time:
-                    logger.info("Webhook 计时器到期，触发优雅刷新。")
-                    if await redis_client.set("webhook:trigger_lock", "1", ex=60, nx=True):
-                        await redis_client.delete("webhook:refresh_timer_due")
-                        await redis_client.lpush("task_queue", json.dumps({"task": "refresh_all"}))
-
-        except (redis.ConnectionError, asyncio.CancelledError) as e:
-            logger.error("Redis 连接错误或任务取消，Webhook 监视器暂停5秒: %s", e)
-            await asyncio.sleep(5)
-        except Exception as e:
-            logger.exception("Webhook 监视器发生未知错误: %s", e)
-
-        await asyncio.sleep(5)
-
+# 任务处理器与延时任务调度器位于 worker.py，可由独立进程 (python -m worker) 运行
 
 # --- 7. 启动和关闭事件 (使用 Lifespan) ---
 
@@ -95,6 +47,9 @@ async def lifespan(app: FastAPI):
     logger.info("FastAPI 应用启动...")
 
     # --- Startup ---
+    background_tasks = []
+    worker_tasks = []
+
     # 1. 配置检查
     if not config.SECRET_KEY:
         logger.critical("SECRET_KEY 未设置，拒绝启动。")
@@ -115,10 +70,16 @@ async def lifespan(app: FastAPI):
         await db_init()
         logger.info(f"Worker (pid: {os.getpid()}) db_init() 完成。")
 
-        # 4. 启动后台任务
+        # 4. 打开 Outline 共享连接池 (所有 Outline API 调用复用)
+        await init_outline_client()
+
+        # 5. 启动后台任务
         if redis_client:
-            asyncio.create_task(task_worker())
-            asyncio.create_task(webhook_watcher())
+            if config.RUN_BACKGROUND_WORKERS:
+                worker_tasks = start_background_workers()
+            else:
+                logger.info("RUN_BACKGROUND_WORKERS=false，本进程不运行任务处理器与延时任务调度器。")
+            background_tasks.append(asyncio.create_task(invalidation_listener()))
         else:
             logger.warning("Redis 未配置，后台任务和 Webhook 计时器将不会启动。")
 
@@ -130,10 +91,18 @@ async def lifespan(app: FastAPI):
 
     # --- Shutdown ---
     logger.info("FastAPI 应用关闭...")
+    if worker_tasks:
+        await stop_background_workers(worker_tasks)
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await close_outline_client()
     if async_engine:
         await async_engine.dispose()
     if redis_client:
         await redis_client.close()
+    if redis_binary_client:
+        await redis_binary_client.close()
     logger.info("资源已释放。")
 
 
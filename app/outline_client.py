@@ -1,16 +1,33 @@
 # app/outline_client.py
+import asyncio
 import hashlib
 import hmac
 import logging
+from typing import AsyncIterator, Optional
 
 import httpx
 from httpx import Response
 from httpx_retries import RetryTransport, Retry
 
 import config
+from rate_limiter import RateLimitedTransport
 
 logger = logging.getLogger(__name__)
 
+# 进程级共享客户端 (由 main.lifespan 打开/关闭)
+_shared_client: Optional[httpx.AsyncClient] = None
+
+# 重试耗尽后仍视为暂时性的状态码 (与 Retry 策略的 status_forcelist 一致)
+_TRANSIENT_STATUSES = {429, 500, 502, 503, 504}
+
+
+class OutlineUnavailableError(RuntimeError):
+    """Outline 暂时不可用 (传输错误、429/5xx)：调用方应让任务失败并稍后重试，而不是当作文档不存在。"""
+
+
+class OutlineListingIncomplete(RuntimeError):
+    """文档/知识库枚举未能完成 (某一页请求失败)：调用方不能把未出现的文档当作已删除。"""
+
 # --- HTTP 辅助函数 (httpx) ---
 def _create_retry_client() -> httpx.AsyncClient:
     """创建带重试的 httpx.AsyncClient"""
@@ -23,95 +40,174 @@ def _create_retry_client() -> httpx.AsyncClient:
         allowed_methods=["POST", "GET"],
     )
 
-    # 2. 定义要包装的底层 transport (保留 http2)
-    base_transport = httpx.AsyncHTTPTransport(http2=True)
+    # 2. 定义要包装的底层 transport (保留 http2，并限制连接池大小)
+    limits = httpx.Limits(
+        max_connections=config.OUTLINE_HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=config.OUTLINE_HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=config.OUTLINE_HTTP_KEEPALIVE_EXPIRY,
+    )
+    base_transport = httpx.AsyncHTTPTransport(http2=True, limits=limits)
 
-    # 3. 使用 'transport' 参数
+    # 3. 使用 'transport' 参数 (每次实际请求，包括重试，都先经过按主机的自适应限流器)
     transport = RetryTransport(
         retry=retry_strategy,
-        transport=base_transport
+        transport=RateLimitedTransport(base_transport)
     )
 
     # 4. 创建客户端
     client = httpx.AsyncClient(transport=transport, timeout=60)
     return client
 
+async def init_outline_client() -> httpx.AsyncClient:
+    """创建 (或复用) 进程级共享的 Outline 客户端。在 lifespan 启动时调用。"""
+    global _shared_client
+    if _shared_client is None or _shared_client.is_closed:
+        _shared_client = _create_retry_client()
+        logger.info(
+            "Outline 共享 HTTP/2 客户端已创建 (max_connections=%s, max_keepalive=%s)。",
+            config.OUTLINE_HTTP_MAX_CONNECTIONS, config.OUTLINE_HTTP_MAX_KEEPALIVE
+        )
+    return _shared_client
+
+async def close_outline_client():
+    """关闭进程级共享的 Outline 客户端。在 lifespan 关闭时调用。"""
+    global _shared_client
+    if _shared_client is not None:
+        await _shared_client.aclose()
+        _shared_client = None
+        logger.info("Outline 共享 HTTP/2 客户端已关闭。")
+
+async def get_outline_client() -> httpx.AsyncClient:
+    """返回共享客户端；若 lifespan 未初始化 (如脚本调用)，则惰性创建。"""
+    if _shared_client is None or _shared_client.is_closed:
+        return await init_outline_client()
+    return _shared_client
+
 async def http_post_json_raw(url, payload, headers=None, client: httpx.AsyncClient = None):
-    """异步 POST"""
-    should_close = False
+    """
+    异步 POST (未显式传入 client 时使用共享连接池)。
+    其他非 2xx (如 404 文档已删除) 返回 None；传输错误与 429/5xx 抛出 OutlineUnavailableError。
+    """
     if client is None:
-        client = _create_retry_client()
-        should_close = True
+        client = await get_outline_client()
 
     try:
         resp: Response = await client.post(
             url, json=payload, headers=headers or {"Content-Type":"application/json"}
         )
-        if not (200 <= resp.status_code < 300):
-            logger.warning(f"http_post_json_raw (async) non-2xx: {resp.status_code} for URL {url} - Body: {resp.text}")
-            return None
-        return resp.json()
     except httpx.HTTPError as e:
         logger.warning(f"http_post_json_raw (async) error for URL {url}: {e}")
+        raise OutlineUnavailableError(f"{url}: {e}") from e
+
+    if resp.status_code in _TRANSIENT_STATUSES:
+        logger.warning(f"http_post_json_raw (async) transient {resp.status_code} for URL {url}")
+        raise OutlineUnavailableError(f"{url}: HTTP {resp.status_code}")
+    if not (200 <= resp.status_code < 300):
+        logger.warning(f"http_post_json_raw (async) non-2xx: {resp.status_code} for URL {url} - Body: {resp.text}")
         return None
-    finally:
-        if should_close:
-            await client.aclose()
+    return resp.json()
 
 # --- Outline API 函数 ---
 def outline_headers():
     return {"Authorization": f"Bearer {config.OUTLINE_API_TOKEN}", "Content-Type": "application/json"}
 
-async def outline_list_collections(client: httpx.AsyncClient):
+async def _paginate(url, payload, client: httpx.AsyncClient, label: str) -> AsyncIterator[list]:
+    """
+    Outline offset 分页的异步迭代器，逐页 yield data 列表。
+    每轮同时请求 OUTLINE_LIST_PAGE_WINDOW 页，遇到不满页即停止；
+    任一页请求失败时抛出 OutlineListingIncomplete (暂时性错误为 OutlineUnavailableError)。
+    """
+    limit = max(1, config.OUTLINE_LIST_PAGE_SIZE)
+    window = max(1, config.OUTLINE_LIST_PAGE_WINDOW)
+    offset = 0
+
+    while True:
+        offsets = [offset + i * limit for i in range(window)]
+        pages = await asyncio.gather(*(
+            http_post_json_raw(url, {**payload, "limit": limit, "offset": o}, headers=outline_headers(), client=client)
+            for o in offsets
+        ))
+
+        for data in pages:
+            if not data:
+                logger.warning(f"获取 {label} 的一页数据失败。")
+                raise OutlineListingIncomplete(f"failed to list {label}")
+            items = data.get("data") or []
+            if items:
+                yield items
+            if len(items) < limit:
+                return
+
+        offset += window * limit
+
+async def outline_list_collections(client: httpx.AsyncClient = None):
+    if client is None:
+        client = await get_outline_client()
     u = f"{config.OUTLINE_API_URL}/api/collections.list"
-    data = await http_post_json_raw(u, {"limit": 100}, headers=outline_headers(), client=client)
-    if not data or not data.get("data"):
-        logger.error("无法从 Outline 获取知识库列表。")
-        return []
-    return data["data"]
-
-async def outline_list_docs():
-    client = _create_retry_client()
+    collections = []
+    async for page in _paginate(u, {}, client, "知识库列表"):
+        collections.extend(page)
+    return collections
+
+_LIST_DONE = object()
+
+async def outline_list_docs() -> AsyncIterator[dict]:
+    """
+    流式枚举所有知识库中的文档 (按 id 去重)。
+    多个知识库以 OUTLINE_LIST_CONCURRENCY 为上限并发分页，
+    调用方可以在枚举结束前就开始处理已返回的文档。
+    知识库列表或任一页获取失败时，在已返回的文档之后抛出
+    OutlineListingIncomplete / OutlineUnavailableError；正常结束即表示枚举完整。
+    """
+    client = await get_outline_client()
+    collections = await outline_list_collections(client=client)
+    if not collections:
+        logger.warning("Outline 中没有任何知识库。")
+        return
+
+    u = f"{config.OUTLINE_API_URL}/api/documents.list"
+    # 有界队列：消费者变慢时自动对分页请求施加背压
+    page_queue: asyncio.Queue = asyncio.Queue(maxsize=64)
+    semaphore = asyncio.Semaphore(max(1, config.OUTLINE_LIST_CONCURRENCY))
+
+    async def _list_collection(collection):
+        collection_id = collection.get("id")
+        if not collection_id:
+            return
+        async with semaphore:
+            label = f"知识库 '{collection.get('name')}'"
+            async for docs in _paginate(u, {"collectionId": collection_id}, client, label):
+                await page_queue.put(docs)
+
+    async def _list_all():
+        tasks = [asyncio.create_task(_list_collection(c)) for c in collections]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # 某个知识库失败时停止其余分页 (gather 不会取消它们)
+            for task in tasks:
+                task.cancel()
+            await page_queue.put(_LIST_DONE)
+
+    producer = asyncio.create_task(_list_all())
+    seen_ids = set()
     try:
-        collections = await outline_list_collections(client=client)
-        if not collections:
-            logger.warning("未找到任何知识库，或无法获取知识库列表。将返回空文档列表。")
-            return []
-
-        all_docs = {}
-        for collection in collections:
-            collection_id = collection.get("id")
-            if not collection_id:
-                continue
-
-            docs_in_collection = []
-            limit, offset = 100, 0
-            u = f"{config.OUTLINE_API_URL}/api/documents.list"
-
-            while True:
-                payload = {"collectionId": collection_id, "limit": limit, "offset": offset}
-                data = await http_post_json_raw(u, payload, headers=outline_headers(), client=client)
-
-                if not data:
-                    logger.warning(f"获取知识库 '{collection.get('name')}' 的一页文档失败。")
-                    break
-
-                docs = data.get("data", [])
-                docs_in_collection.extend(docs)
-
-                if len(docs) < limit:
-                    break
-                offset += limit
-
-            for doc in docs_in_collection:
-                if doc.get("id"):
-                    all_docs[doc['id']] = doc
-
-        total_docs_list = list(all_docs.values())
-        logger.info(f"从Outline API获取到 {len(total_docs_list)} 篇不重复的文档。")
-        return total_docs_list
+        while True:
+            docs = await page_queue.get()
+            if docs is _LIST_DONE:
+                break
+            for doc in docs:
+                doc_id = doc.get("id")
+                if doc_id and doc_id not in seen_ids:
+                    seen_ids.add(doc_id)
+                    yield doc
+        # 传播生产者中的异常
+        await producer
     finally:
-        await client.aclose()
+        if not producer.done():
+            producer.cancel()
+
+    logger.info(f"从Outline API获取到 {len(seen_ids)} 篇不重复的文档。")
 
 
 async def outline_get_doc(doc_id):
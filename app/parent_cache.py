@@ -0,0 +1,114 @@
+# app/parent_cache.py
+# 每个 worker 进程内的父文档缓存 (按字节数限制容量)，通过 Redis pub/sub 跨进程失效
+import asyncio
+import json
+import logging
+import sys
+from typing import List, Optional, Sequence, Tuple
+
+import redis.asyncio as redis
+from langchain_core.documents import Document
+
+import config
+from database import redis_client
+from lru_cache import ByteLRU
+
+logger = logging.getLogger(__name__)
+
+# 失效通知频道：消息体为 JSON 编码的 source_id 列表
+INVALIDATION_CHANNEL = "rag:parent_invalidate"
+
+
+def _sizeof_entry(entry: Tuple[Optional[str], Document]) -> int:
+    _version, doc = entry
+    return sys.getsizeof(doc.page_content) + sys.getsizeof(json.dumps(doc.metadata, ensure_ascii=False))
+
+
+class ParentDocumentCache:
+    """
+    以 source_id 为键、以 outline_updated_at_str 为版本的父文档 LRU。
+    查询时版本不一致视为未命中；文档变更或删除时通过 pub/sub 主动失效。
+    """
+
+    def __init__(self, max_bytes: int):
+        self.lru = ByteLRU(max_bytes, sizeof=_sizeof_entry)
+
+    def get(self, source_id: str, version: Optional[str]) -> Optional[Document]:
+        entry = self.lru.get(source_id)
+        if entry is None:
+            return None
+        cached_version, doc = entry
+        if cached_version != version:
+            self.lru.delete(source_id)
+            return None
+        return doc
+
+    def put(self, source_id: str, version: Optional[str], doc: Document) -> None:
+        self.lru.set(source_id, (version, doc))
+
+    def invalidate(self, source_ids: Sequence[str]) -> None:
+        for source_id in source_ids:
+            self.lru.delete(source_id)
+
+    async def aget_parents(self, store, items: Sequence[Tuple[str, Optional[str]]]) -> List[Optional[Document]]:
+        """
+        items: [(source_id, outline_updated_at_str)]，按顺序返回父文档。
+        未命中的部分一次性从 store.amget 获取并回填。
+        """
+        results: List[Optional[Document]] = [self.get(sid, version) for sid, version in items]
+        missing = [i for i, doc in enumerate(results) if doc is None]
+        if missing:
+            fetched = await store.amget([items[i][0] for i in missing])
+            for i, doc in zip(missing, fetched):
+                if doc is not None:
+                    results[i] = doc
+                    # 以存储中的实际版本入缓存，避免把旧版本登记为新版本
+                    self.put(items[i][0], doc.metadata.get("outline_updated_at_str"), doc)
+        logger.debug(f"ParentDocumentCache: {len(items) - len(missing)}/{len(items)} hits, {self.lru.stats()}")
+        return results
+
+
+parent_cache = ParentDocumentCache(config.PARENT_CACHE_MAX_BYTES)
+
+
+async def publish_invalidation(source_ids: Sequence[str]) -> None:
+    """通知所有 worker 丢弃这些文档的缓存 (同时立即清理本进程)。"""
+    if not source_ids:
+        return
+    parent_cache.invalidate(source_ids)
+    if not redis_client:
+        return
+    try:
+        await redis_client.publish(INVALIDATION_CHANNEL, json.dumps(list(source_ids)))
+    except Exception as e:
+        logger.warning(f"发布父文档缓存失效通知失败 (non-fatal): {e}")
+
+
+async def invalidation_listener():
+    """后台订阅失效频道。每次 (重新) 订阅前清空缓存，以免错过断线期间的通知。"""
+    logger.info("父文档缓存失效监听器已启动 (异步)。")
+    while True:
+        pubsub = redis_client.pubsub()
+        try:
+            await pubsub.subscribe(INVALIDATION_CHANNEL)
+            parent_cache.lru.clear()
+            async for message in pubsub.listen():
+                if message.get("type") != "message":
+                    continue
+                try:
+                    parent_cache.invalidate(json.loads(message["data"]))
+                except (json.JSONDecodeError, TypeError) as e:
+                    logger.warning(f"无法解析父文档缓存失效消息: {e}")
+        except asyncio.CancelledError:
+            raise
+        except redis.ConnectionError as e:
+            logger.error("Redis 连接错误，父文档缓存失效监听器暂停5秒: %s", e)
+            await asyncio.sleep(5)
+        except Exception as e:
+            logger.exception("父文档缓存失效监听器发生未知错误: %s", e)
+            await asyncio.sleep(1)
+        finally:
+            try:
+                await pubsub.aclose()
+            except Exception:
+                pass
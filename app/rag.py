@@ -1,38 +1,54 @@
 # app/rag.py
 import asyncio
+import hashlib
 import json
 import logging
-import pickle
+from collections import defaultdict
+from dataclasses import dataclass, field
 from datetime import datetime, timezone
 from typing import Optional
 
 from langchain.retrievers.contextual_compression import ContextualCompressionRetriever
 from langchain.retrievers.document_compressors.base import DocumentCompressorPipeline
-from langchain.storage import EncoderBackedStore
-from langchain_community.storage.sql import SQLStore
 from langchain_core.documents import Document
 from langchain_core.retrievers import BaseRetriever
-from langchain_core.stores import BaseStore
 from langchain_postgres.v2.async_vectorstore import AsyncPGVectorStore
 from langchain_postgres.v2.engine import PGEngine
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from sqlalchemy import text
 
 import config
-from database import async_engine, AsyncSessionLocal, redis_client as async_redis_client
-from llm_services import embeddings_model, reranker
-from outline_client import outline_list_docs, outline_get_doc, outline_export_doc
+from chunk_writer import replace_document_chunks, delete_documents
+from database import async_engine, AsyncSessionLocal, lexical_search_available, redis_client as async_redis_client
+from docstore import ParentDocumentStore, PARENT_STORE_NAMESPACE, encode_parent_document
+from hybrid_retriever import HybridRetriever
+from ingest_pipeline import Stage, run_pipeline
+from llm_services import embeddings_model, reranker, count_tokens
+from outline_client import (
+    OutlineListingIncomplete, OutlineUnavailableError, outline_list_docs, outline_get_doc, outline_export_doc
+)
+from parent_cache import publish_invalidation
+from retrieval_cache import bump_corpus_generation
+from task_queue import enqueue_task
 
 logger = logging.getLogger(__name__)
 
 vector_store: Optional[AsyncPGVectorStore] = None
-parent_store: Optional[BaseStore[str, Document]] = None
+parent_store: Optional[ParentDocumentStore] = None
 base_retriever: Optional[BaseRetriever] = None
 compression_retriever: Optional[ContextualCompressionRetriever] = None
 
 _rag_lock = asyncio.Lock()
 
 
+class DocumentsFailedError(RuntimeError):
+    """部分文档因暂时性错误 (Outline/Embedding 不可用、数据库错误) 未能处理，任务应只重试这些文档。"""
+
+    def __init__(self, message: str, failed_ids: list):
+        super().__init__(message)
+        self.failed_ids = failed_ids
+
+
 async def initialize_rag_components():
     global vector_store, base_retriever, compression_retriever, parent_store
 
@@ -43,26 +59,19 @@ async def initialize_rag_components():
         if vector_store:
             return
 
-        logger.info("Initializing RAG components (AsyncEngine, PGVectorStore v2, SQLStore)...")
+        logger.info("Initializing RAG components (AsyncEngine, PGVectorStore v2, ParentDocumentStore)...")
 
         if not async_engine:
             raise ValueError("AsyncEngine from database.py is not available")
         if not config.DATABASE_URL:
             raise ValueError("DATABASE_URL is not set, but is required for SQLStore")
 
-        base_sql_store = SQLStore(
+        # 版本化 + 压缩编码，元数据与正文分离 (不再使用 pickle)
+        parent_store = ParentDocumentStore(
             engine=async_engine,
-            namespace="rag_parent_documents"
-        )
-        logger.info(f"Async SQLStore for ParentStore configured (engine=async_engine, namespace='rag_parent_documents').")
-
-        parent_store = EncoderBackedStore[str, Document](
-            store=base_sql_store,
-            key_encoder=lambda k: k,
-            value_serializer=pickle.dumps,
-            value_deserializer=pickle.loads
+            namespace=PARENT_STORE_NAMESPACE
         )
-        logger.info("ParentStore configured (EncoderBackedStore over SQLStore).")
+        logger.info(f"ParentStore configured (ParentDocumentStore, namespace='{PARENT_STORE_NAMESPACE}').")
 
         pg_engine_wrapper = PGEngine.from_engine(async_engine)
         try:
@@ -75,6 +84,9 @@ async def initialize_rag_components():
                     "title",
                     "outline_updated_at_str",
                     "url",
+                    "content_hash",
+                    "chunk_index",
+                    "token_count",
                 ],
             )
             logger.info("AsyncPGVectorStore (v2) initialized (using explicit metadata columns).")
@@ -82,10 +94,24 @@ async def initialize_rag_components():
             logger.critical(f"Failed to initialize PGVectorStore: {e}", exc_info=True)
             raise
 
-        base_retriever = vector_store.as_retriever(
-            search_kwargs={"k": config.TOP_K}
-        )
-        logger.info(f"Base chunk retriever configured (PGVectorStore.as_retriever, k={config.TOP_K}).")
+        if lexical_search_available():
+            base_retriever = HybridRetriever(
+                vector_store=vector_store,
+                vector_k=config.HYBRID_VECTOR_K,
+                lexical_k=config.HYBRID_LEXICAL_K,
+                lexical_weight=config.HYBRID_LEXICAL_WEIGHT,
+                rrf_k=config.HYBRID_RRF_K,
+                top_k=config.TOP_K,
+            )
+            logger.info(
+                f"Base chunk retriever configured (HybridRetriever: vector k={config.HYBRID_VECTOR_K} + "
+                f"lexical k={config.HYBRID_LEXICAL_K}, RRF -> {config.TOP_K})."
+            )
+        else:
+            base_retriever = vector_store.as_retriever(
+                search_kwargs={"k": config.TOP_K}
+            )
+            logger.info(f"Base chunk retriever configured (PGVectorStore.as_retriever, k={config.TOP_K}).")
 
         pipeline_compressor = DocumentCompressorPipeline(
             transformers=[
@@ -116,7 +142,236 @@ child_splitter = RecursiveCharacterTextSplitter(
 )
 
 
-async def process_doc_batch_task(doc_ids: list):
+def _chunk_content_hash(content: str) -> str:
+    """块内容的稳定哈希 (sha256)，用于重新导入时识别未变化的块。"""
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def _diff_chunks(existing_rows, new_chunks: list) -> tuple[list, list, list]:
+    """
+    比较库中已有块与新切分出的块 (只用于决定哪些块需要求向量；
+    写入时 replace_document_chunks 会在文档锁内按最新状态重新配对)。
+    existing_rows: [(langchain_id, source_id, content_hash)]
+    返回 (需要删除的 langchain_id 列表, 需要新增的块列表, 保留块的 (source_id, content_hash, 新 chunk_index) 列表)。
+    content_hash 为 NULL 的旧行永远不会被匹配，因此会被替换。
+    """
+    existing = defaultdict(list)
+    for langchain_id, source_id, content_hash in existing_rows:
+        existing[(source_id, content_hash)].append(langchain_id)
+
+    chunks_to_insert = []
+    kept_chunks = []
+    for chunk in new_chunks:
+        key = (chunk.metadata["source_id"], chunk.metadata["content_hash"])
+        if existing.get(key):
+            # 内容相同的块已存在：保留原行 (同一文档内的重复块逐个配对)，
+            # 但其在文档中的序号可能已经变化
+            existing[key].pop()
+            kept_chunks.append((*key, chunk.metadata["chunk_index"]))
+        else:
+            chunks_to_insert.append(chunk)
+
+    ids_to_delete = [langchain_id for ids in existing.values() for langchain_id in ids]
+    return ids_to_delete, chunks_to_insert, kept_chunks
+
+
+async def _fetch_outline_document(doc_id, listed: Optional[dict] = None) -> Optional[Document]:
+    """
+    构造单篇文档的 LangChain Document。
+    若 refresh_all_task 已从 documents.list 带来了元数据 (listed)，则跳过 documents.info；
+    若还带来了正文 (text)，则同时跳过 documents.export。
+    无法获取或内容为空时返回 None (由调用方计入 skipped)。
+    """
+    if listed and listed.get("updatedAt"):
+        info = listed
+    else:
+        info = await outline_get_doc(doc_id)
+        if not info:
+            logger.warning(f"无法获取文档 {doc_id} 的 *信息* (metadata)，跳过。")
+            return None
+
+    export_data = listed.get("text") if listed else None
+    if not export_data:
+        export_data = await outline_export_doc(doc_id)
+    if not export_data:
+        logger.warning(f"无法获取文档 {doc_id} 的 *内容* (export)，跳过。")
+        return None
+
+    content = export_data or ""
+    if not content.strip():
+        logger.info(f"Document {doc_id} (title: {info.get('title')}) is empty, skipping.")
+        return None
+
+    updated_at_str = info.get("updatedAt")
+    if not updated_at_str:
+        now_dt = datetime.now(timezone.utc)
+        updated_at_str = now_dt.isoformat().replace('+00:00', 'Z')
+
+    return Document(
+        page_content=content,
+        metadata={
+            "source_id": doc_id,
+            "title": info.get("title") or "",
+            "outline_updated_at_str": updated_at_str,
+            "url": info.get("url")
+        }
+    )
+
+
+@dataclass
+class _DocWork:
+    """在摄取流水线各阶段之间传递的单篇文档工作单元。"""
+    doc_id: str
+    listed: Optional[dict] = None
+    parent_doc: Optional[Document] = None
+    chunks_to_insert: list = field(default_factory=list)
+    kept_chunks: list = field(default_factory=list)
+    embeddings: list = field(default_factory=list)
+    # 写入 documents 清单的整篇文档状态
+    content_hash: Optional[str] = None
+    chunk_count: int = 0
+
+
+def _split_parent_doc(parent_doc: Document) -> list:
+    """将父文档切分为子块，注入父标题并计算 content_hash。"""
+    # 获取父文档标题
+    parent_title = parent_doc.metadata.get("title") or ""
+
+    # 我们*只*使用 child_splitter (RecursiveCharacterTextSplitter)
+    # 来对*整个*父文档 (parent_doc) 进行分割。
+    # child_splitter (separators=["\n\n", "\n", ...])
+    # 会创建大小合适 (1024) 且语义连贯的块。
+    # 这会保留 Markdown 标题 (如 "#简介") 在块内容中，
+    # 这对于语义搜索是友好的。
+
+    # [分割]：使用 child_splitter (Recursive) 对 *整个文档* 进行分割
+    #    split_document 会自动将 parent_doc.metadata 复制到所有子块中。
+    sub_chunks = child_splitter.split_documents([parent_doc])
+
+    chunks = []
+    # [处理子块]：
+    for chunk in sub_chunks:
+        # 'chunk' 已经从 parent_doc 继承了元数据 (source_id, title, url...)
+
+        # [注入父标题]：将父标题强行注入 page_content (保持不变)
+        # 这为块提供了额外的上下文，告诉模型它来自哪个文档。
+        if parent_title:
+            chunk.page_content = f"文档标题: {parent_title}\n\n{chunk.page_content}"
+
+        if not chunk.page_content.strip():
+            continue
+
+        chunk.metadata["content_hash"] = _chunk_content_hash(chunk.page_content)
+        # 块在文档中的序号，用于检索时扩展相邻块窗口
+        chunk.metadata["chunk_index"] = len(chunks)
+        # 预计算 token 数，供查询时按预算打包上下文
+        chunk.metadata["token_count"] = count_tokens(chunk.page_content)
+        chunks.append(chunk)
+
+    # 整篇父文档的 token 数 (须在切分之后写入，避免被复制到子块元数据中)
+    parent_doc.metadata["token_count"] = count_tokens(parent_doc.page_content)
+    return chunks
+
+
+async def _stage_fetch(batch: list) -> list:
+    """[fetch] 从 Outline 获取文档 (或复用 documents.list 带来的内容)。"""
+    out = []
+    for work in batch:
+        work.parent_doc = await _fetch_outline_document(work.doc_id, work.listed)
+        if work.parent_doc is not None:
+            out.append(work)
+    return out
+
+
+async def _stage_split(batch: list) -> list:
+    """[split] 切分 (放到线程中，避免阻塞事件循环) 并与库中已有块做 diff。"""
+    for work in batch:
+        chunks = await asyncio.to_thread(_split_parent_doc, work.parent_doc)
+        work.content_hash = _chunk_content_hash(work.parent_doc.page_content)
+        work.chunk_count = len(chunks)
+
+        # [块级 diff]：只删除已消失的块、只新增变化的块，
+        # 内容未变的块保留原有向量与 HNSW 节点。
+        async with AsyncSessionLocal.begin() as session:
+            existing_rows = (await session.execute(
+                text("""
+                     SELECT langchain_id, source_id, content_hash FROM langchain_pg_embedding
+                     WHERE source_id = :source_id
+                     """),
+                {"source_id": work.doc_id}
+            )).fetchall()
+
+        ids_to_delete, work.chunks_to_insert, work.kept_chunks = _diff_chunks(existing_rows, chunks)
+        logger.debug(
+            f"Chunk diff for {work.doc_id}: {len(chunks) - len(work.chunks_to_insert)} unchanged, "
+            f"{len(work.chunks_to_insert)} to insert, {len(ids_to_delete)} to delete."
+        )
+    return batch
+
+
+async def _stage_embed(batch: list) -> list:
+    """[embed] 合并多篇文档的新增/变化块，一次性交给按 token 打包的 Embedding 客户端。"""
+    texts = [chunk.page_content for work in batch for chunk in work.chunks_to_insert]
+    if not texts:
+        return batch
+
+    vectors = await embeddings_model.aembed_documents(texts)
+    offset = 0
+    for work in batch:
+        n = len(work.chunks_to_insert)
+        work.embeddings = vectors[offset:offset + n]
+        offset += n
+    return batch
+
+
+async def _stage_write(batch: list) -> list:
+    """
+    [write] 通过 COPY + 单事务原子替换一批文档的块与父文档
+    (删除过期块、写入新块、同步元数据与 documents 清单、upsert ParentStore)。
+    同一文档被并发改写时抛出 ChunkWriteConflict，本批文档计为失败并由任务重试。
+    """
+    await replace_document_chunks(
+        new_chunks=[
+            (chunk, embedding)
+            for work in batch
+            for chunk, embedding in zip(work.chunks_to_insert, work.embeddings)
+        ],
+        kept_chunks=[kept for work in batch for kept in work.kept_chunks],
+        doc_updates=[
+            {
+                "source_id": work.doc_id,
+                "title": work.parent_doc.metadata.get("title"),
+                "updated_at": work.parent_doc.metadata.get("outline_updated_at_str"),
+                "url": work.parent_doc.metadata.get("url"),
+                "content_hash": work.content_hash,
+                "chunk_count": work.chunk_count,
+                "token_count": work.parent_doc.metadata.get("token_count"),
+            }
+            for work in batch
+        ],
+        parents=[(work.doc_id, encode_parent_document(work.parent_doc)) for work in batch],
+        parent_namespace=PARENT_STORE_NAMESPACE,
+    )
+
+    # 通知所有 worker 丢弃这些文档的父文档缓存，并使已缓存的检索结果失效
+    await publish_invalidation([work.doc_id for work in batch])
+    await bump_corpus_generation()
+
+    # 写入完成后释放大对象，保证内存只受队列深度约束
+    for work in batch:
+        work.parent_doc, work.chunks_to_insert, work.kept_chunks, work.embeddings = None, [], [], []
+    return batch
+
+
+async def process_doc_batch_task(doc_ids: list, listed_docs: Optional[list] = None, track_progress: bool = True):
+    """
+    处理一批文档: fetch -> split -> embed -> write 四阶段流水线。
+    各阶段通过有界队列衔接并各自限制并发 (INGEST_* 配置)，
+    网络密集与数据库密集的阶段相互重叠，内存占用由队列深度而非批大小决定。
+    listed_docs: 可选，refresh_all_task 从 documents.list 带来的文档摘要
+    (id/title/url/updatedAt/text)，用于省去重复的 Outline 请求。
+    track_progress: 是否计入全量刷新的 refresh:* 进度计数 (Webhook 增量任务为 False)。
+    """
     await initialize_rag_components()
 
     if not vector_store or not parent_store:
@@ -128,126 +383,37 @@ async def process_doc_batch_task(doc_ids: list):
 
     successful_ids_final = set()
     skipped_ids_final = set()
-    docs_to_process_lc = []
-
-    try:
-        for doc_id in doc_ids:
-            info = await outline_get_doc(doc_id)
-            if not info:
-                logger.warning(f"无法获取文档 {doc_id} 的 *信息* (metadata)，跳过。")
-                skipped_ids_final.add(doc_id)
-                continue
-
-            export_data = await outline_export_doc(doc_id)
-            if not export_data:
-                logger.warning(f"无法获取文档 {doc_id} 的 *内容* (export)，跳过。")
-                skipped_ids_final.add(doc_id)
-                continue
-
-            content = export_data or ""
-            if not content.strip():
-                logger.info(f"Document {doc_id} (title: {info.get('title')}) is empty, skipping.")
-                skipped_ids_final.add(doc_id)
-                continue
-
-            updated_at_str = info.get("updatedAt")
-            if not updated_at_str:
-                now_dt = datetime.now(timezone.utc)
-                updated_at_str = now_dt.isoformat().replace('+00:00', 'Z')
-
-            doc = Document(
-                page_content=content,
-                metadata={
-                    "source_id": doc_id,
-                    "title": info.get("title") or "",
-                    "outline_updated_at_str": updated_at_str,
-                    "url": info.get("url")
-                }
-            )
-            docs_to_process_lc.append(doc)
+    # 因异常失败的文档 (区别于内容为空/已删除的 skipped)：不计入进度，由任务重试
+    failed_ids_final = set()
 
-        if docs_to_process_lc:
-            chunks_to_add = []
-            parents_to_add = []
-            source_ids_to_process = []
+    def _on_error(work: _DocWork, exc: Exception):
+        failed_ids_final.add(work.doc_id)
+        logger.warning(f"处理文档 {work.doc_id} 失败，将重试: {exc}", exc_info=exc)
 
-            for parent_doc in docs_to_process_lc:
-                source_id = parent_doc.metadata.get("source_id")
-                if not source_id:
-                    logger.warning(f"Skipping document with no source_id: {parent_doc.metadata.get('title')}")
-                    continue
-
-                source_ids_to_process.append(source_id)
-                parents_to_add.append((source_id, parent_doc))
-
-                # 获取父文档标题
-                parent_title = parent_doc.metadata.get("title") or ""
-
-                # 我们*只*使用 child_splitter (RecursiveCharacterTextSplitter)
-                # 来对*整个*父文档 (parent_doc) 进行分割。
-                # child_splitter (separators=["\n\n", "\n", ...])
-                # 会创建大小合适 (1024) 且语义连贯的块。
-                # 这会保留 Markdown 标题 (如 "#简介") 在块内容中，
-                # 这对于语义搜索是友好的。
-
-                # [分割]：使用 child_splitter (Recursive) 对 *整个文档* 进行分割
-                #    split_document 会自动将 parent_doc.metadata 复制到所有子块中。
-                sub_chunks = child_splitter.split_documents([parent_doc])
-
-                # [处理子块]：
-                for chunk in sub_chunks:
-                    # 'chunk' 已经从 parent_doc 继承了元数据 (source_id, title, url...)
-
-                    # [注入父标题]：将父标题强行注入 page_content (保持不变)
-                    # 这为块提供了额外的上下文，告诉模型它来自哪个文档。
-                    if parent_title:
-                        chunk.page_content = f"文档标题: {parent_title}\n\n{chunk.page_content}"
-
-                    if not chunk.page_content.strip():
-                        continue
-
-                    chunks_to_add.append(chunk)
-
-            if chunks_to_add:
-                logger.info(f"Processing {len(chunks_to_add)} chunks for {len(docs_to_process_lc)} documents...")
-
-                ids_to_delete = []
-                try:
-                    async with AsyncSessionLocal.begin() as session:
-                        ids_to_delete_rows = (await session.execute(
-                            text("""
-                                 SELECT langchain_id FROM langchain_pg_embedding
-                                 WHERE source_id = ANY(:source_ids)
-                                 """),
-                            {"source_ids": source_ids_to_process}
-                        )).fetchall()
-                        ids_to_delete = [row[0] for row in ids_to_delete_rows]
-                except Exception as e:
-                    logger.error(f"Failed to query old chunk UUIDs (async): {e}. Skipping delete.", exc_info=True)
-                    ids_to_delete = []
-
-                if ids_to_delete:
-                    logger.info(f"Deleting {len(ids_to_delete)} old chunks from PGVectorStore for {len(source_ids_to_process)} docs...")
-                    await vector_store.adelete(ids=ids_to_delete)
-
-                try:
-                    await parent_store.amset(parents_to_add)
-                    await vector_store.aadd_documents(chunks_to_add)
-
-                except Exception as e:
-                    logger.error(f"Failed (async) to add {len(chunks_to_add)} chunks or {len(parents_to_add)} parent docs: {e}.", exc_info=True)
-                    raise e
-
-            for doc in docs_to_process_lc:
-                successful_ids_final.add(doc.metadata["source_id"])
+    try:
+        listed_map = {d["id"]: d for d in (listed_docs or []) if d.get("id")}
+        work_items = [_DocWork(doc_id=doc_id, listed=listed_map.get(doc_id)) for doc_id in doc_ids]
+        queue_depth = config.INGEST_QUEUE_DEPTH
+
+        completed = await run_pipeline(
+            work_items,
+            [
+                Stage("fetch", _stage_fetch, concurrency=config.OUTLINE_FETCH_CONCURRENCY, queue_depth=queue_depth),
+                Stage("split", _stage_split, concurrency=config.INGEST_SPLIT_CONCURRENCY, queue_depth=queue_depth),
+                Stage("embed", _stage_embed, concurrency=config.INGEST_EMBED_CONCURRENCY, queue_depth=queue_depth,
+                      batch_size=config.INGEST_EMBED_BATCH_SIZE),
+                Stage("write", _stage_write, concurrency=config.INGEST_WRITE_CONCURRENCY, queue_depth=queue_depth,
+                      batch_size=config.INGEST_WRITE_BATCH_SIZE),
+            ],
+            on_error=_on_error,
+            label=f"ingest batch ({len(doc_ids)} docs)",
+        )
 
-    except Exception as e:
-        logger.error(f"Batch task for doc_ids {doc_ids} failed during processing: {e}", exc_info=True)
-        successful_ids_final = set()
-        skipped_ids_final = set(doc_ids)
+        successful_ids_final = {work.doc_id for work in completed}
+        skipped_ids_final = set(doc_ids) - successful_ids_final - failed_ids_final
 
     finally:
-        if async_redis_client:
+        if async_redis_client and track_progress:
             try:
                 p = async_redis_client.pipeline()
                 if successful_ids_final:
@@ -259,124 +425,314 @@ async def process_doc_batch_task(doc_ids: list):
             except Exception as e:
                 logger.error("Failed to update Redis refresh counters (async) in finally block: %s", e)
 
-    logger.info(f"Batch task complete (async): {len(successful_ids_final)} processed, {len(skipped_ids_final)} skipped.")
+    logger.info(
+        f"Batch task complete (async): {len(successful_ids_final)} processed, "
+        f"{len(skipped_ids_final)} skipped, {len(failed_ids_final)} failed."
+    )
+    if failed_ids_final:
+        raise DocumentsFailedError(
+            f"{len(failed_ids_final)} of {len(doc_ids)} docs failed", sorted(failed_ids_final)
+        )
+
+
+# --- 检索：相邻块窗口扩展 ---
+
+def _strip_title_prefix(content: str, title: Optional[str]) -> str:
+    """去掉切分时注入的 "文档标题: ..." 前缀。"""
+    prefix = f"文档标题: {title}\n\n"
+    return content[len(prefix):] if title and content.startswith(prefix) else content
+
+
+def _join_overlapping(texts: list, max_overlap: int = 256, min_overlap: int = 10) -> str:
+    """拼接相邻块，去掉 child_splitter 产生的首尾重叠部分 (过短的重合视为巧合，不去重)。"""
+    if not texts:
+        return ""
+    merged = texts[0]
+    for nxt in texts[1:]:
+        overlap = 0
+        for k in range(min(len(merged), len(nxt), max_overlap), min_overlap - 1, -1):
+            if merged.endswith(nxt[:k]):
+                overlap = k
+                break
+        merged += nxt[overlap:] if overlap else "\n" + nxt
+    return merged
+
+
+def _merge_windows(ordinals, radius: int) -> list:
+    """将命中块序号扩展为 [i-radius, i+radius] 窗口，并合并重叠/相邻的窗口。"""
+    windows = []
+    for i in sorted(set(ordinals)):
+        lo, hi = max(0, i - radius), i + radius
+        if windows and lo <= windows[-1][1] + 1:
+            windows[-1][1] = max(windows[-1][1], hi)
+        else:
+            windows.append([lo, hi])
+    return windows
+
+
+async def expand_chunk_windows(chunks: list) -> dict:
+    """
+    将重排后的命中块扩展为 "命中块 + 相邻块" 的窗口文档 (每个 source_id 一篇)。
+    返回 {source_id: Document}；短文档 (块数 <= RAG_WHOLE_DOC_MAX_CHUNKS)
+    或缺少 chunk_index 的旧数据不在结果中，调用方应回退为整篇父文档。
+    """
+    hits = defaultdict(list)
+    best_score = {}
+    for chunk in chunks:
+        source_id, ordinal = chunk.metadata.get("source_id"), chunk.metadata.get("chunk_index")
+        if source_id is None or ordinal is None:
+            continue
+        hits[source_id].append(ordinal)
+        score = chunk.metadata.get("relevance_score")
+        if score is not None and score > best_score.get(source_id, float("-inf")):
+            best_score[source_id] = score
+
+    if not hits:
+        return {}
+
+    async with AsyncSessionLocal() as session:
+        counts = dict((await session.execute(
+            text("""
+                 SELECT source_id, chunk_count FROM documents
+                 WHERE source_id = ANY(:source_ids)
+                 """),
+            {"source_ids": list(hits.keys())}
+        )).fetchall())
+
+        windows = {
+            sid: _merge_windows(ordinals, config.RAG_CONTEXT_WINDOW)
+            for sid, ordinals in hits.items()
+            if counts.get(sid, 0) > config.RAG_WHOLE_DOC_MAX_CHUNKS
+        }
+        if not windows:
+            return {}
+
+        flat = [(sid, lo, hi) for sid, ws in windows.items() for lo, hi in ws]
+        rows = (await session.execute(
+            text("""
+                 SELECT e.source_id, e.chunk_index, e.content, e.title, e.url, e.outline_updated_at_str, e.token_count
+                 FROM langchain_pg_embedding e
+                 JOIN unnest(CAST(:sids AS text[]), CAST(:los AS int[]), CAST(:his AS int[])) AS w(sid, lo, hi)
+                   ON e.source_id = w.sid AND e.chunk_index BETWEEN w.lo AND w.hi
+                 ORDER BY e.source_id, e.chunk_index
+                 """),
+            {"sids": [f[0] for f in flat], "los": [f[1] for f in flat], "his": [f[2] for f in flat]}
+        )).mappings().all()
+
+    by_source = defaultdict(list)
+    for row in rows:
+        by_source[row["source_id"]].append(row)
+
+    expanded = {}
+    for sid, ws in windows.items():
+        doc_rows = by_source.get(sid)
+        if not doc_rows:
+            continue
+        sections = []
+        for lo, hi in ws:
+            texts = [_strip_title_prefix(r["content"], r["title"]) for r in doc_rows if lo <= r["chunk_index"] <= hi]
+            if texts:
+                sections.append(_join_overlapping(texts))
+        first = doc_rows[0]
+        # 预计算值之和 (含重叠与标题前缀，偏保守)；缺失时交给打包器现场计算
+        token_counts = [r["token_count"] for r in doc_rows]
+        token_count = sum(token_counts) if all(isinstance(t, int) for t in token_counts) else None
+        expanded[sid] = Document(
+            page_content="\n\n...\n\n".join(sections),
+            metadata={
+                "source_id": sid,
+                "title": first["title"],
+                "url": first["url"],
+                "outline_updated_at_str": first["outline_updated_at_str"],
+                "context_windows": ws,
+                "relevance_score": best_score.get(sid),
+                "token_count": token_count,
+            }
+        )
+    return expanded
+
+
+# documents.list 返回的文档字段中，批处理任务需要的部分 (正文另按 REFRESH_INLINE_TEXT_MAX_BYTES 限量携带)
+_LISTED_DOC_FIELDS = ("id", "title", "url", "updatedAt")
+
+
+async def _enqueue_doc_batch(listed_docs: list):
+    """
+    将一批待处理文档推入任务队列，并累加 refresh:total_queued。
+    同时携带 documents.list 已返回的元数据，批处理时无需再次请求 documents.info；
+    正文在 REFRESH_INLINE_TEXT_MAX_BYTES 以内随任务携带，超出部分不写入 Redis，
+    由 worker 通过 documents.export 拉取。
+    """
+    docs, inline_bytes = [], 0
+    for d in listed_docs:
+        entry = {k: d.get(k) for k in _LISTED_DOC_FIELDS}
+        doc_text = d.get("text")
+        if doc_text:
+            size = len(doc_text.encode("utf-8"))
+            if inline_bytes + size <= config.REFRESH_INLINE_TEXT_MAX_BYTES:
+                entry["text"] = doc_text
+                inline_bytes += size
+        docs.append(entry)
+
+    task = {
+        "task": "process_doc_batch",
+        "doc_ids": [d["id"] for d in listed_docs],
+        "docs": docs,
+    }
+    p = async_redis_client.pipeline()
+    p.incrby("refresh:total_queued", len(listed_docs))
+    enqueue_task(task, pipeline=p)
+    await p.execute()
 
 
 async def refresh_all_task():
     await initialize_rag_components()
 
+    queued_count = 0
     try:
-        remote_docs_raw = await outline_list_docs()
-        if remote_docs_raw is None:
-            raise ConnectionError("Failed to retrieve document list from Outline API.")
-
-        remote_docs_map = {doc['id']: doc['updatedAt'] for doc in remote_docs_raw if doc.get('id') and doc.get('updatedAt')}
-
         local_docs_map = {}
         try:
             async with AsyncSessionLocal.begin() as session:
+                # 读取 documents 清单 (每篇文档一行)，无需扫描整张块表
                 local_docs_raw = (await session.execute(
                     text("""
-                         SELECT DISTINCT ON (source_id)
-                             source_id as id,
-                             outline_updated_at_str
-                         FROM langchain_pg_embedding
-                         WHERE source_id IS NOT NULL
+                         SELECT source_id as id, outline_updated_at_str
+                         FROM documents
                          """)
                 )).mappings().all()
-                local_docs_map = {doc['id']: doc['outline_updated_at_str'] for doc in local_docs_raw if doc.get('id') and doc.get('outline_updated_at_str')}
+                # 版本为 NULL 的文档 (如父文档迁移失败) 保留在映射中：与远端版本必然不同而被重新摄取
+                local_docs_map = {doc['id']: doc['outline_updated_at_str'] for doc in local_docs_raw if doc.get('id')}
         except Exception as e:
-            logger.error(f"Failed to read metadata from PGVectorStore (async): {e}", exc_info=True)
-
-        remote_ids = set(remote_docs_map.keys())
-        local_ids = set(local_docs_map.keys())
-
-        to_add_ids = list(remote_ids - local_ids)
-        to_delete_ids = list(local_ids - remote_ids)
-        to_check_ids = remote_ids.intersection(local_ids)
-
-        to_update_ids = [doc_id for doc_id in to_check_ids if remote_docs_map[doc_id] != local_docs_map.get(doc_id)]
-
-        if to_delete_ids:
-            logger.warning(f"Found {len(to_delete_ids)} docs locally that are not remote. Deleting...")
-            for doc_id in to_delete_ids:
-                await delete_doc(doc_id)
-
-        docs_to_process_ids = to_add_ids + to_update_ids
-        if not docs_to_process_ids:
-            final_message = f"Refresh complete. Removed {len(to_delete_ids)} old docs." if to_delete_ids else "Refresh complete. Data is up to date."
-            logger.info(final_message)
-            if async_redis_client:
-                status = {"status": "success", "message": final_message}
-                await async_redis_client.set("refresh:status", json.dumps(status), ex=300)
-            return
+            logger.error(f"Failed to read document manifest (async): {e}", exc_info=True)
 
+        # 枚举期间标记 refresh:listing，避免 /api/refresh/status
+        # 在已入队批次先行完成时误判为刷新结束。
         if async_redis_client:
             try:
                 p = async_redis_client.pipeline()
-                p.set("refresh:total_queued", len(docs_to_process_ids))
+                p.set("refresh:listing", "1", ex=3600)
+                # total_queued 仅在首个批次入队时由 INCRBY 创建：其不存在即表示本次刷新未入队任何批次，
+                # 结束时 (包括失败) 据此释放 refresh:lock
+                p.delete("refresh:total_queued")
                 p.set("refresh:success_count", 0)
                 p.set("refresh:skipped_count", 0)
-                p.set("refresh:delete_count", len(to_delete_ids))
                 p.delete("refresh:status")
                 await p.execute()
             except Exception as e:
                 logger.error("Failed to initialize Redis refresh counters (async): %s", e)
 
+        # [流式 diff]：边枚举边比对，每凑满一个批次立即入队，
+        # 让 process_doc_batch 与剩余的枚举并行进行。
         batch_size = config.REFRESH_BATCH_SIZE
-        num_batches = (len(docs_to_process_ids) + batch_size - 1) // batch_size
-        logger.info(f"{len(docs_to_process_ids)} docs need update/add, splitting into {num_batches} batches.")
+        remote_ids = set()
+        pending_batch = []
+        num_batches = 0
 
-        for i in range(0, len(docs_to_process_ids), batch_size):
-            batch = docs_to_process_ids[i:i+batch_size]
-            task = {"task": "process_doc_batch", "doc_ids": batch}
-            await async_redis_client.lpush("task_queue", json.dumps(task))
+        listing_error = None
+        try:
+            async for doc in outline_list_docs():
+                doc_id, updated_at = doc.get('id'), doc.get('updatedAt')
+                if not doc_id or not updated_at:
+                    continue
+                remote_ids.add(doc_id)
+
+                if local_docs_map.get(doc_id) != updated_at:
+                    pending_batch.append(doc)
+                    if len(pending_batch) >= batch_size:
+                        await _enqueue_doc_batch(pending_batch)
+                        queued_count += len(pending_batch)
+                        num_batches += 1
+                        pending_batch = []
+        except (OutlineListingIncomplete, OutlineUnavailableError) as e:
+            listing_error = e
+
+        if pending_batch:
+            await _enqueue_doc_batch(pending_batch)
+            queued_count += len(pending_batch)
+            num_batches += 1
+
+        if listing_error is not None:
+            # 枚举不完整时，未出现的文档不一定已被删除：已入队的更新照常处理，跳过删除阶段后重试
+            logger.error(f"Document listing incomplete, skipping deletion phase: {listing_error}")
+            raise listing_error
+
+        to_delete_ids = list(set(local_docs_map.keys()) - remote_ids)
 
-        logger.info(f"Queued {len(docs_to_process_ids)} doc processing tasks.")
+        if to_delete_ids:
+            logger.warning(f"Found {len(to_delete_ids)} docs locally that are not remote. Deleting...")
+            await delete_docs(to_delete_ids)
+
+        if async_redis_client:
+            p = async_redis_client.pipeline()
+            p.set("refresh:delete_count", len(to_delete_ids))
+            if not queued_count:
+                p.delete("refresh:total_queued", "refresh:success_count", "refresh:skipped_count")
+            await p.execute()
+
+        if not queued_count:
+            final_message = f"Refresh complete. Removed {len(to_delete_ids)} old docs." if to_delete_ids else "Refresh complete. Data is up to date."
+            logger.info(final_message)
+            if async_redis_client:
+                status = {"status": "success", "message": final_message}
+                await async_redis_client.set("refresh:status", json.dumps(status), ex=300)
+            return
+
+        logger.info(f"Queued {queued_count} doc processing tasks in {num_batches} batches.")
 
     except Exception as e:
         logger.exception("refresh_all_task (async) failed: %s", e)
         if async_redis_client:
             status = {"status": "error", "message": f"Refresh failed: {e}"}
-            await async_redis_client.set("refresh:status", json.dumps(status), ex=300)
+            p = async_redis_client.pipeline()
+            p.set("refresh:status", json.dumps(status), ex=300)
+            if not queued_count:
+                # 未入队任何批次：释放锁与计数，重试 (或下一次刷新) 可重新获取
+                p.delete("refresh:lock", "refresh:total_queued", "refresh:success_count", "refresh:skipped_count")
+            await p.execute()
+        # 交给任务队列按退避重试
+        raise
     finally:
-        if async_redis_client and not (await async_redis_client.exists("refresh:total_queued")):
-            await async_redis_client.delete("refresh:lock")
+        if async_redis_client:
+            await async_redis_client.delete("refresh:listing")
+            if not (await async_redis_client.exists("refresh:total_queued")):
+                await async_redis_client.delete("refresh:lock")
 
 
-async def delete_doc(doc_id):
-    await initialize_rag_components()
+# 单条 DELETE 语句中的 source_id 数量上限
+_DELETE_SLICE_SIZE = 1000
 
-    if not vector_store or not parent_store:
-        logger.critical("Vector store or Parent store not initialized in delete_doc!")
-        raise RuntimeError("RAG components (vector_store/parent_store) not initialized")
 
-    ids_to_delete = []
-    try:
-        async with AsyncSessionLocal.begin() as session:
-            ids_to_delete_rows = (await session.execute(
-                text("""
-                     SELECT langchain_id FROM langchain_pg_embedding
-                     WHERE source_id = :source_id
-                     """),
-                {"source_id": doc_id}
-            )).fetchall()
-            ids_to_delete = [row[0] for row in ids_to_delete_rows]
-    except Exception as e:
-        logger.error(f"Failed to query old chunk UUIDs for {doc_id} (async): {e}", exc_info=True)
+async def delete_docs(doc_ids: list):
+    """
+    批量删除文档的所有块、父文档与清单行：每 _DELETE_SLICE_SIZE 篇一个事务。
+    """
+    await initialize_rag_components()
+
+    if not doc_ids:
         return
 
-    if ids_to_delete:
+    total_chunks, total_parents, deleted_any = 0, 0, False
+    failed_ids = []
+    for i in range(0, len(doc_ids), _DELETE_SLICE_SIZE):
+        id_slice = list(doc_ids[i:i + _DELETE_SLICE_SIZE])
         try:
-            await vector_store.adelete(ids=ids_to_delete)
-            logger.info(f"Deleted from PGVectorStore: {doc_id} ({len(ids_to_delete)} chunks)")
+            chunks_deleted, parents_deleted = await delete_documents(id_slice, PARENT_STORE_NAMESPACE)
+            total_chunks += chunks_deleted
+            total_parents += parents_deleted
         except Exception as e:
-            logger.error(f"vector_store.adelete (async) failed for {doc_id} (chunks: {ids_to_delete}): {e}", exc_info=True)
-    else:
-        logger.info(f"No chunks found in PGVectorStore to delete for: {doc_id}")
+            logger.error(f"Bulk delete (async) failed for {len(id_slice)} docs: {e}", exc_info=True)
+            failed_ids.extend(id_slice)
+            continue
+        await publish_invalidation(id_slice)
+        deleted_any = True
 
-    try:
-        await parent_store.amdelete([doc_id])
-        logger.info(f"Deleted from ParentStore (SQLStore): {doc_id}")
-    except Exception as e:
-        logger.error(f"parent_store.amdelete (async) failed for {doc_id}: {e}", exc_info=True)
\ No newline at end of file
+    if deleted_any:
+        await bump_corpus_generation()
+
+    logger.info(f"Deleted {len(doc_ids) - len(failed_ids)} docs: {total_chunks} chunks, {total_parents} parent docs.")
+    if failed_ids:
+        raise DocumentsFailedError(f"failed to delete {len(failed_ids)} of {len(doc_ids)} docs", failed_ids)
+
+
+async def delete_doc(doc_id):
+    await delete_docs([doc_id])
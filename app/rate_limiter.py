@@ -0,0 +1,251 @@
+# app/rate_limiter.py
+# 上游 API 的进程级自适应限流：每个主机一个令牌桶 + AIMD 并发上限，遵循 Retry-After，
+# 并按优先级通道排队 (交互式对话请求先于摄取请求)。
+#
+# 通过 RateLimitedTransport 接入 httpx，因此对 Outline、Reranker、Embedding 与 Chat
+# 客户端透明；当前请求所属的通道由 contextvar 决定 (默认交互式，后台任务切换为摄取)。
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+import httpx
+
+import config
+
+logger = logging.getLogger(__name__)
+
+LANE_INTERACTIVE = "interactive"
+LANE_INGEST = "ingest"
+_LANE_PRIORITY = {LANE_INTERACTIVE: 0, LANE_INGEST: 1}
+
+_current_lane: contextvars.ContextVar[str] = contextvars.ContextVar("rate_limit_lane", default=LANE_INTERACTIVE)
+
+# 视为过载、需要收缩并发的状态码
+_BACKOFF_STATUSES = {429, 500, 502, 503, 504}
+# 两次乘性减小之间的最短间隔 (秒)，避免同一波失败把并发一次性压到最低
+_DECREASE_COOLDOWN = 1.0
+
+
+@contextmanager
+def priority_lane(lane: str):
+    """在该上下文 (及其创建的子任务) 中发出的上游请求使用指定通道排队。"""
+    token = _current_lane.set(lane)
+    try:
+        yield
+    finally:
+        _current_lane.reset(token)
+
+
+def current_lane() -> str:
+    return _current_lane.get()
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After 可以是秒数或 HTTP 日期。"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class HostLimiter:
+    """
+    单个主机的限流器。
+    - 令牌桶：rate 个/秒，容量 burst；
+    - AIMD 并发：成功时 limit += 1/limit，429/5xx/传输错误时 limit *= 0.5 (不低于 1)；
+    - Retry-After：在指定时间前阻塞该主机的所有新请求；
+    - 等待者按 (通道优先级, 到达顺序) 排队。
+    """
+
+    def __init__(self, host: str, rate: float, burst: int, max_concurrency: int):
+        self.host = host
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.tokens = float(burst)
+        self.blocked_until = 0.0
+        self._updated = time.monotonic()
+        self._last_decrease = 0.0
+        self._cond = asyncio.Condition()
+        self._waiting: list = []
+        self._seq = itertools.count()
+
+    def _refill(self, now: float):
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _ready_in(self, now: float) -> Optional[float]:
+        """距可以放行的秒数；0 表示立即可放行，None 表示须等待并发槽位释放。"""
+        if self.in_flight >= max(1, int(self.limit)):
+            return None
+        wait = max(0.0, self.blocked_until - now)
+        if self.rate > 0 and self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    async def acquire(self, lane: str = LANE_INTERACTIVE):
+        ticket = (_LANE_PRIORITY.get(lane, 1), next(self._seq))
+        async with self._cond:
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    wait = self._ready_in(now)
+                    if wait == 0 and self._waiting[0] == ticket:
+                        heapq.heappop(self._waiting)
+                        if self.rate > 0:
+                            self.tokens -= 1
+                        self.in_flight += 1
+                        # 让下一个等待者重新检查
+                        self._cond.notify_all()
+                        return
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), timeout=wait or None)
+                    except TimeoutError:
+                        pass
+            except BaseException:
+                if ticket in self._waiting:
+                    self._waiting.remove(ticket)
+                    heapq.heapify(self._waiting)
+                    self._cond.notify_all()
+                raise
+
+    async def release(self, status: Optional[int], retry_after: Optional[float] = None):
+        """status 为 None 表示传输错误 (超时、连接失败)。"""
+        async with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if status is None or status in _BACKOFF_STATUSES:
+                if now - self._last_decrease >= _DECREASE_COOLDOWN:
+                    self.limit = max(1.0, self.limit / 2)
+                    self._last_decrease = now
+                    logger.warning(
+                        f"上游 {self.host} 过载 (status={status})，并发上限降至 {int(self.limit)}。"
+                    )
+            elif status < 400:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+                logger.warning(f"上游 {self.host} 要求 Retry-After {retry_after:.1f}s。")
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        return {
+            "host": self.host,
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "waiting": len(self._waiting),
+            "blocked_for": max(0.0, self.blocked_until - time.monotonic()),
+        }
+
+
+_limiters: Dict[str, HostLimiter] = {}
+
+
+def _host_settings(host: str) -> tuple:
+    outline_host = urlparse(config.OUTLINE_API_URL).hostname
+    if host == outline_host:
+        return config.OUTLINE_RATE_LIMIT_RPS, config.OUTLINE_RATE_LIMIT_BURST, config.OUTLINE_MAX_CONCURRENCY
+    return config.SILICONFLOW_RATE_LIMIT_RPS, config.SILICONFLOW_RATE_LIMIT_BURST, config.SILICONFLOW_MAX_CONCURRENCY
+
+
+def get_limiter(host: str) -> HostLimiter:
+    limiter = _limiters.get(host)
+    if limiter is None:
+        rate, burst, max_concurrency = _host_settings(host)
+        limiter = _limiters[host] = HostLimiter(host, rate, burst, max_concurrency)
+    return limiter
+
+
+def limiter_stats() -> list:
+    return [limiter.stats() for limiter in _limiters.values()]
+
+
+class _ReleasingStream(httpx.AsyncByteStream):
+    """普通响应在正文读取结束/关闭时才归还并发槽位。"""
+
+    def __init__(self, stream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            await self._on_close()
+
+
+def _is_event_stream(response: httpx.Response) -> bool:
+    return response.headers.get("content-type", "").startswith("text/event-stream")
+
+
+class RateLimitedTransport(httpx.AsyncBaseTransport):
+    """
+    在底层 transport 之前按主机限流；每次实际发出的请求 (含重试) 都经过限流器。
+    SSE 流式响应 (对话生成) 在收到响应头时即归还并发槽位：生成可能持续数十秒，
+    若一直占用槽位，会阻塞同一主机上的重排、Embedding 与其他对话请求。
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self._transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        limiter = get_limiter(request.url.host)
+        await limiter.acquire(current_lane())
+
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException:
+            await limiter.release(None)
+            raise
+
+        released = False
+
+        async def _release():
+            nonlocal released
+            if not released:
+                released = True
+                await limiter.release(
+                    response.status_code, _parse_retry_after(response.headers.get("Retry-After"))
+                )
+
+        if _is_event_stream(response):
+            await _release()
+            return response
+
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_ReleasingStream(response.stream, _release),
+            extensions=response.extensions,
+            request=request,
+        )
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+def rate_limited_client(**client_kwargs) -> httpx.AsyncClient:
+    """创建经由限流器的 httpx.AsyncClient (供 ChatSiliconFlow / OpenAI 兼容客户端使用)。"""
+    return httpx.AsyncClient(transport=RateLimitedTransport(httpx.AsyncHTTPTransport()), **client_kwargs)
@@ -0,0 +1,79 @@
+# app/retrieval_cache.py
+# 检索结果缓存：键为 (语料代数, 检索配置指纹, 规范化的改写查询)，值为重排后的块摘要。
+# 摄取与删除在写入后递增全局语料代数，旧条目随之不可达 (TTL 只负责回收)。
+import hashlib
+import json
+import logging
+from typing import List, Optional, Tuple
+
+from langchain_core.documents import Document
+
+import config
+from database import redis_client
+from llm_services import QueryCachedEmbeddings
+
+logger = logging.getLogger(__name__)
+
+GENERATION_KEY = "rag:corpus_generation"
+_CACHE_PREFIX = "rag:retrieval"
+# 命中后重建块所需的元数据 (expand_chunk_windows 与父文档获取只依赖这些字段)
+_CACHED_FIELDS = ("source_id", "chunk_index", "outline_updated_at_str", "relevance_score")
+
+
+def _settings_fingerprint() -> str:
+    """影响检索结果的配置；变更后 (如重新部署) 自动使用新的键空间。"""
+    settings = (
+        config.EMBEDDING_MODEL, config.RERANKER_MODEL, config.TOP_K, config.K,
+        config.HYBRID_SEARCH_ENABLED, config.HYBRID_VECTOR_K, config.HYBRID_LEXICAL_K,
+        config.HYBRID_LEXICAL_WEIGHT, config.HYBRID_RRF_K,
+    )
+    return hashlib.sha256(repr(settings).encode()).hexdigest()[:12]
+
+
+_FINGERPRINT = _settings_fingerprint()
+
+
+def _cache_key(generation: str, query: str) -> str:
+    digest = hashlib.sha256(QueryCachedEmbeddings.normalize(query).encode("utf-8")).hexdigest()
+    return f"{_CACHE_PREFIX}:{generation}:{_FINGERPRINT}:{digest}"
+
+
+async def bump_corpus_generation() -> None:
+    """语料 (块或父文档) 发生变化后调用，使所有已缓存的检索结果失效。"""
+    if not redis_client:
+        return
+    try:
+        await redis_client.incr(GENERATION_KEY)
+    except Exception as e:
+        logger.warning(f"递增语料代数失败 (non-fatal): {e}")
+
+
+async def lookup(query: str) -> Tuple[Optional[str], Optional[List[Document]]]:
+    """
+    返回 (generation, chunks)。generation 须在检索之前读取并传给 store()：
+    检索期间若语料变化，结果会写入旧代数而不会被读到。
+    """
+    if not config.RETRIEVAL_CACHE_ENABLED or not redis_client:
+        return None, None
+    try:
+        generation = await redis_client.get(GENERATION_KEY) or "0"
+        cached = await redis_client.get(_cache_key(generation, query))
+    except Exception as e:
+        logger.warning(f"检索结果缓存读取失败 (non-fatal): {e}")
+        return None, None
+    if cached is None:
+        return generation, None
+    chunks = [Document(page_content="", metadata=item) for item in json.loads(cached)]
+    logger.debug(f"Retrieval cache hit (generation {generation}): {len(chunks)} chunks.")
+    return generation, chunks
+
+
+async def store(query: str, generation: Optional[str], chunks: List[Document]) -> None:
+    # 空结果可能来自重排服务的临时错误，不缓存
+    if generation is None or not chunks:
+        return
+    payload = [{field: chunk.metadata.get(field) for field in _CACHED_FIELDS} for chunk in chunks]
+    try:
+        await redis_client.set(_cache_key(generation, query), json.dumps(payload), ex=config.RETRIEVAL_CACHE_TTL)
+    except Exception as e:
+        logger.warning(f"检索结果缓存写入失败 (non-fatal): {e}")
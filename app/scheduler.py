@@ -0,0 +1,133 @@
+# app/scheduler.py
+# 延时任务调度：Redis ZSET (job_id -> 到期时间) + HASH (job_id -> 任务 JSON)。
+# 到期任务由 Lua 脚本原子地取出并追加到其类型的任务流，任意多个进程同时调度也不会重复投递。
+#
+# 同一 job_id 重复调度会覆盖任务内容并推迟到期时间 (即防抖)；
+# only_if_absent=True 时已存在的调度保持不变 (用于周期性任务的引导)。
+import asyncio
+import json
+import logging
+import time
+from typing import Optional
+
+import redis.asyncio as redis
+
+from database import redis_client
+from task_queue import STREAM_KEY, TASK_TYPES, stream_for
+
+logger = logging.getLogger(__name__)
+
+DELAYED_KEY = "jobs:delayed"
+PAYLOAD_KEY = "jobs:payload"
+# 调度新任务时推入的唤醒信号，调度循环阻塞在 BLPOP 上等待
+WAKEUP_KEY = "jobs:wakeup"
+# 没有更早的任务时，调度循环最长阻塞的秒数
+_MAX_IDLE_SECONDS = 60
+# 单次取出的到期任务数上限
+_CLAIM_BATCH = 100
+
+# KEYS: delayed zset, payload hash, 默认任务流, 各类型任务流 (与 ARGV[3..] 的类型名一一对应)
+# ARGV: now, limit, 任务类型名...
+_CLAIM_DUE_SCRIPT = """
+local streams = {}
+for i = 3, #ARGV do
+    streams[ARGV[i]] = KEYS[i + 1]
+end
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, job_id in ipairs(due) do
+    redis.call('ZREM', KEYS[1], job_id)
+    local payload = redis.call('HGET', KEYS[2], job_id)
+    redis.call('HDEL', KEYS[2], job_id)
+    if payload then
+        local ok, task = pcall(cjson.decode, payload)
+        local stream = KEYS[3]
+        if ok and type(task) == 'table' and streams[task['task']] then
+            stream = streams[task['task']]
+        end
+        redis.call('XADD', stream, '*', 'task', payload)
+    end
+end
+return #due
+"""
+
+_claim_due = None
+
+
+async def schedule(task: dict, delay: float, job_id: Optional[str] = None, only_if_absent: bool = False) -> bool:
+    """
+    在 delay 秒后把 task 投递到任务流。未指定 job_id 时每次调度都是独立任务。
+    返回是否实际登记 (only_if_absent 且已存在时为 False)。
+    """
+    job_id = job_id or f"job:{time.time_ns()}"
+    due_time = time.time() + max(0.0, delay)
+    payload = json.dumps(task)
+
+    p = redis_client.pipeline()
+    if only_if_absent:
+        p.zadd(DELAYED_KEY, {job_id: due_time}, nx=True)
+        p.hsetnx(PAYLOAD_KEY, job_id, payload)
+    else:
+        p.zadd(DELAYED_KEY, {job_id: due_time})
+        p.hset(PAYLOAD_KEY, job_id, payload)
+    # 唤醒调度循环重新计算下一次到期时间 (列表只保留一个信号)
+    p.lpush(WAKEUP_KEY, "1")
+    p.ltrim(WAKEUP_KEY, 0, 0)
+    added, *_ = await p.execute()
+    return bool(added) or not only_if_absent
+
+
+async def cancel(job_id: str):
+    p = redis_client.pipeline()
+    p.zrem(DELAYED_KEY, job_id)
+    p.hdel(PAYLOAD_KEY, job_id)
+    await p.execute()
+
+
+async def dispatch_due_jobs() -> int:
+    """原子地把所有已到期的任务移入任务流，返回移动的任务数。"""
+    global _claim_due
+    if _claim_due is None:
+        _claim_due = redis_client.register_script(_CLAIM_DUE_SCRIPT)
+
+    total = 0
+    while True:
+        moved = await _claim_due(
+            keys=[DELAYED_KEY, PAYLOAD_KEY, STREAM_KEY, *(stream_for(name) for name in TASK_TYPES)],
+            args=[time.time(), _CLAIM_BATCH, *TASK_TYPES],
+        )
+        total += int(moved)
+        if int(moved) < _CLAIM_BATCH:
+            return total
+
+
+async def _seconds_until_next_due() -> float:
+    head = await redis_client.zrange(DELAYED_KEY, 0, 0, withscores=True)
+    if not head:
+        return _MAX_IDLE_SECONDS
+    return min(_MAX_IDLE_SECONDS, max(0.0, head[0][1] - time.time()))
+
+
+async def scheduler_loop():
+    """
+    调度循环：投递到期任务后阻塞到下一次到期 (或被新调度唤醒)。
+    空闲时每 _MAX_IDLE_SECONDS 秒只有一次阻塞读取。
+    """
+    logger.info("延时任务调度器已启动 (异步)。")
+    while True:
+        try:
+            moved = await dispatch_due_jobs()
+            if moved:
+                logger.info(f"延时任务调度器: {moved} 个到期任务已投递。")
+
+            timeout = await _seconds_until_next_due()
+            if timeout > 0:
+                await redis_client.blpop([WAKEUP_KEY], timeout=timeout)
+
+        except asyncio.CancelledError:
+            raise
+        except redis.ConnectionError as e:
+            logger.error("Redis 连接错误，延时任务调度器暂停5秒: %s", e)
+            await asyncio.sleep(5)
+        except Exception as e:
+            logger.exception("延时任务调度器发生未知错误: %s", e)
+            await asyncio.sleep(1)
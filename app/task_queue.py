@@ -0,0 +1,275 @@
+# app/task_queue.py
+# 基于 Redis Streams 的可靠任务队列：消费者组、确认、可见性超时回收、有限重试与死信流
+#
+# 每种任务类型一个流 (tasks:stream:<task>)，worker 只从本进程仍有空闲槽位的类型的流中读取，
+# 某类型达到并发上限时其任务留在流中按原顺序等待，而不是被读出再放回队尾。
+# 未知类型 (及旧版单一流中残留的任务) 使用默认流 STREAM_KEY。
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, List, Optional
+
+import redis.asyncio as redis
+
+import config
+from database import redis_client
+
+logger = logging.getLogger(__name__)
+
+STREAM_KEY = "tasks:stream"
+TASK_TYPES = ("refresh_all", "process_doc_batch", "delete_docs")
+GROUP_NAME = "workers"
+DEAD_LETTER_KEY = "tasks:dead"
+# 每个条目的投递次数 ("<stream>|<entry_id>" -> attempts)，确认或转入死信后删除
+ATTEMPTS_KEY = "tasks:attempts"
+# 按任务类型累计的计数与耗时 ("<task>:succeeded" / ":failed" / ":dead" / ":reclaimed" / ":duration_ms")
+METRICS_KEY = "tasks:metrics"
+# 旧版 LPUSH/BRPOP 列表，启动时迁移其中残留的任务
+_LEGACY_LIST_KEY = "task_queue"
+
+
+def stream_for(task_name: Optional[str]) -> str:
+    """任务类型对应的流。"""
+    return f"{STREAM_KEY}:{task_name}" if task_name in TASK_TYPES else STREAM_KEY
+
+
+ALL_STREAMS = (STREAM_KEY, *(stream_for(name) for name in TASK_TYPES))
+
+
+class PartialTaskFailure(Exception):
+    """处理器部分失败：重试与死信使用 retry_data (如只含失败的文档) 代替原任务内容。"""
+
+    def __init__(self, message: str, retry_data: dict):
+        super().__init__(message)
+        self.retry_data = retry_data
+
+
+@dataclass
+class TaskEntry:
+    stream: str
+    entry_id: str
+    data: Optional[dict]
+    attempts: int
+    raw: Optional[str] = None
+
+    @property
+    def name(self) -> str:
+        return (self.data or {}).get("task") or "unknown"
+
+    @property
+    def attempts_field(self) -> str:
+        return _attempts_field(self.stream, self.entry_id)
+
+
+def _attempts_field(stream: str, entry_id: str) -> str:
+    return f"{stream}|{entry_id}"
+
+
+def consumer_name() -> str:
+    """消费者名：主机名 + 进程号 (每个 worker 进程一个)。"""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def enqueue_task(task: dict, pipeline=None):
+    """
+    追加一个任务到其类型的任务流。传入 pipeline 时只登记命令 (由调用方 execute)，
+    否则返回可 await 的协程。
+    任务流不按长度裁剪：已确认的条目会被 XDEL，流长度即未完成的任务数，裁剪只会丢弃尚未投递的任务。
+    """
+    target = pipeline if pipeline is not None else redis_client
+    return target.xadd(stream_for(task.get("task")), {"task": json.dumps(task)})
+
+
+async def ensure_group():
+    """为所有任务流创建消费者组 (幂等)，并把旧列表中残留的任务迁移到对应的任务流。"""
+    for stream in ALL_STREAMS:
+        try:
+            await redis_client.xgroup_create(stream, GROUP_NAME, id="0", mkstream=True)
+            logger.info(f"已创建任务流消费者组 {stream}/{GROUP_NAME}。")
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    migrated = 0
+    while True:
+        task_json = await redis_client.rpop(_LEGACY_LIST_KEY)
+        if task_json is None:
+            break
+        try:
+            task_name = json.loads(task_json).get("task")
+        except (json.JSONDecodeError, AttributeError):
+            task_name = None
+        await redis_client.xadd(stream_for(task_name), {"task": task_json})
+        migrated += 1
+    if migrated:
+        logger.info(f"已将旧任务列表中的 {migrated} 个任务迁移到任务流。")
+
+
+async def _to_entry(stream: str, entry_id: str, fields: Optional[dict]) -> TaskEntry:
+    attempts = await redis_client.hincrby(ATTEMPTS_KEY, _attempts_field(stream, entry_id), 1)
+    raw = (fields or {}).get("task")
+    try:
+        data = json.loads(raw) if raw else None
+    except json.JSONDecodeError:
+        data = None
+    if isinstance(data, dict):
+        # 经调度器延时重试的任务携带此前已用掉的投递次数
+        attempts += int(data.get("_attempts", 0))
+    return TaskEntry(stream=stream, entry_id=entry_id, data=data, attempts=attempts, raw=raw)
+
+
+async def read_tasks(consumer: str, streams: List[str], block_ms: int = 5000) -> List[TaskEntry]:
+    """
+    从给定的任务流中领取任务，每个流最多一个 (调用方按流数预留槽位)。
+    先回收超过可见性超时仍未确认的条目 (原消费者崩溃或被重新部署)，
+    没有可回收的条目时再阻塞读取新任务。
+    """
+    if not streams:
+        return []
+
+    min_idle_ms = config.TASK_VISIBILITY_TIMEOUT * 1000
+    for stream in streams:
+        claimed = await redis_client.xautoclaim(
+            stream, GROUP_NAME, consumer, min_idle_time=min_idle_ms, start_id="0-0", count=1
+        )
+        for entry_id, fields in (claimed[1] if len(claimed) > 1 else []):
+            if fields is None:
+                # 条目已不存在，只剩 PEL 记录
+                await redis_client.xack(stream, GROUP_NAME, entry_id)
+                continue
+            entry = await _to_entry(stream, entry_id, fields)
+            await redis_client.hincrby(METRICS_KEY, f"{entry.name}:reclaimed", 1)
+            logger.warning(f"回收超时未确认的任务 {entry.name} ({entry_id})，第 {entry.attempts} 次投递。")
+            return [entry]
+
+    result = await redis_client.xreadgroup(
+        GROUP_NAME, consumer, streams={stream: ">" for stream in streams}, count=1, block=block_ms
+    )
+    entries = []
+    for stream, stream_entries in result or []:
+        for entry_id, fields in stream_entries:
+            entries.append(await _to_entry(stream, entry_id, fields))
+    return entries
+
+
+async def ack(entry: TaskEntry):
+    """确认并删除条目 (已完成的任务不再占用流长度)。"""
+    p = redis_client.pipeline()
+    p.xack(entry.stream, GROUP_NAME, entry.entry_id)
+    p.xdel(entry.stream, entry.entry_id)
+    p.hdel(ATTEMPTS_KEY, entry.attempts_field)
+    await p.execute()
+
+
+async def _heartbeat(entry: TaskEntry, consumer: str):
+    """任务执行期间定期 XCLAIM 自身，重置空闲时间，避免长任务被其他 worker 回收。"""
+    interval = max(1, config.TASK_VISIBILITY_TIMEOUT // 3)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await redis_client.xclaim(entry.stream, GROUP_NAME, consumer, 0, [entry.entry_id], justid=True)
+        except redis.ConnectionError as e:
+            logger.warning(f"任务心跳失败 ({entry.entry_id}): {e}")
+
+
+async def _dead_letter(entry: TaskEntry, error: str, data: Optional[dict] = None):
+    p = redis_client.pipeline()
+    p.xadd(
+        DEAD_LETTER_KEY,
+        {"task": json.dumps(data) if data is not None else (entry.raw or ""),
+         "entry_id": entry.entry_id, "attempts": entry.attempts,
+         "error": error[:2000], "failed_at": int(time.time())},
+        maxlen=config.TASK_STREAM_MAXLEN,
+        approximate=True,
+    )
+    p.xack(entry.stream, GROUP_NAME, entry.entry_id)
+    p.xdel(entry.stream, entry.entry_id)
+    p.hdel(ATTEMPTS_KEY, entry.attempts_field)
+    p.hincrby(METRICS_KEY, f"{entry.name}:dead", 1)
+    await p.execute()
+    logger.error(f"任务 {entry.name} ({entry.entry_id}) 已转入死信流 {DEAD_LETTER_KEY}: {error}")
+
+
+async def _schedule_retry(entry: TaskEntry, data: dict):
+    from scheduler import schedule  # scheduler 依赖本模块的 stream_for
+
+    delay = config.TASK_RETRY_BASE_DELAY * (2 ** (entry.attempts - 1))
+    await schedule({**data, "_attempts": entry.attempts}, delay)
+    await ack(entry)
+    logger.info(f"任务 {entry.name} ({entry.entry_id}) 将在 {delay}s 后重试。")
+
+
+async def run_task(entry: TaskEntry, consumer: str, handler: Callable[[dict], Awaitable[None]],
+                   on_dead: Optional[Callable[[dict], Awaitable[None]]] = None):
+    """
+    执行任务并在成功后确认。失败时确认原条目，并通过延时任务调度器按指数退避
+    (TASK_RETRY_BASE_DELAY * 2^(n-1) 秒) 重新投递；进程崩溃导致的未确认条目
+    则在可见性超时后被回收。投递次数达到 TASK_MAX_ATTEMPTS 时转入死信流，
+    并调用 on_dead 做补偿 (如释放刷新锁)。
+    处理器抛出 PartialTaskFailure 时，重试与死信只针对其 retry_data。
+    """
+    if entry.data is None:
+        await _dead_letter(entry, "invalid task payload")
+        return
+
+    if entry.attempts > config.TASK_MAX_ATTEMPTS:
+        await _dead_letter(entry, f"exceeded {config.TASK_MAX_ATTEMPTS} attempts")
+        if on_dead:
+            await on_dead(entry.data)
+        return
+
+    heartbeat = asyncio.create_task(_heartbeat(entry, consumer))
+    started = time.monotonic()
+    try:
+        await handler(entry.data)
+    except asyncio.CancelledError:
+        # 关闭时不确认，交给其他 worker 回收
+        raise
+    except Exception as e:
+        logger.exception(f"任务 {entry.name} ({entry.entry_id}) 第 {entry.attempts} 次执行失败: {e}")
+        await redis_client.hincrby(METRICS_KEY, f"{entry.name}:failed", 1)
+        data = e.retry_data if isinstance(e, PartialTaskFailure) else entry.data
+        if entry.attempts >= config.TASK_MAX_ATTEMPTS:
+            await _dead_letter(entry, repr(e), data)
+            if on_dead:
+                await on_dead(data)
+        else:
+            await _schedule_retry(entry, data)
+        return
+    finally:
+        heartbeat.cancel()
+
+    duration_ms = int((time.monotonic() - started) * 1000)
+    await ack(entry)
+    p = redis_client.pipeline()
+    p.hincrby(METRICS_KEY, f"{entry.name}:succeeded", 1)
+    p.hincrby(METRICS_KEY, f"{entry.name}:duration_ms", duration_ms)
+    await p.execute()
+    logger.info(f"任务 {entry.name} ({entry.entry_id}) 完成，用时 {duration_ms} ms。")
+
+
+async def queue_metrics() -> dict:
+    """各任务流的长度 (未完成任务数) 与待确认数、死信数与按任务类型的计数。"""
+    p = redis_client.pipeline()
+    for stream in ALL_STREAMS:
+        p.xlen(stream)
+        p.xpending(stream, GROUP_NAME)
+    p.xlen(DEAD_LETTER_KEY)
+    p.hgetall(METRICS_KEY)
+    *per_stream, dead_len, counters = await p.execute()
+
+    streams = {}
+    for i, stream in enumerate(ALL_STREAMS):
+        length, pending = per_stream[2 * i], per_stream[2 * i + 1]
+        streams[stream] = {"length": length, "pending": (pending or {}).get("pending", 0)}
+    return {
+        "stream_length": sum(s["length"] for s in streams.values()),
+        "pending": sum(s["pending"] for s in streams.values()),
+        "streams": streams,
+        "dead_letter": dead_len,
+        "tasks": {k: int(v) for k, v in (counters or {}).items()},
+    }
@@ -0,0 +1,103 @@
+# app/webhook_events.py
+# Outline Webhook 事件解析与按文档防抖：把单篇文档的变更转化为定向的处理/删除延时任务
+import logging
+import time
+from typing import Optional, Tuple
+
+import config
+from outline_client import outline_get_doc
+from scheduler import schedule
+
+logger = logging.getLogger(__name__)
+
+# 延时任务 job_id：同一文档/同一类刷新的重复事件会覆盖并推迟同一个任务 (防抖)
+DOC_JOB_PREFIX = "webhook:doc:"
+REFRESH_JOB_ID = "webhook:refresh"
+RECONCILE_JOB_ID = "refresh:reconcile"
+
+ACTION_UPSERT = "upsert"
+ACTION_DELETE = "delete"
+
+_DOCUMENT_EVENT_ACTIONS = {
+    "documents.create": ACTION_UPSERT,
+    "documents.publish": ACTION_UPSERT,
+    "documents.update": ACTION_UPSERT,
+    "documents.title_change": ACTION_UPSERT,
+    "documents.move": ACTION_UPSERT,
+    "documents.unarchive": ACTION_UPSERT,
+    "documents.restore": ACTION_UPSERT,
+    "documents.archive": ACTION_DELETE,
+    "documents.delete": ACTION_DELETE,
+    "documents.permanent_delete": ACTION_DELETE,
+}
+
+# 会影响已索引文档、但无法定位到单篇文档的事件
+REFRESH_EVENTS = {
+    "collections.delete",
+    "collections.archive",
+    "collections.move",
+    "collections.update",
+}
+
+
+def parse_webhook_event(body: dict) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """
+    解析 Outline Webhook 请求体 ({"event": ..., "payload": {"id": ..., "model": {...}}})。
+    返回 (event, doc_id, action)；非文档事件时 doc_id/action 为 None。
+    """
+    event = body.get("event")
+    action = _DOCUMENT_EVENT_ACTIONS.get(event)
+    if not action:
+        return event, None, None
+
+    payload = body.get("payload") or {}
+    model = payload.get("model") or {}
+    doc_id = model.get("id") or payload.get("id")
+    if not doc_id:
+        return event, None, None
+
+    # 草稿 (未发布) 不进入索引；documents.list 也不会列出它们
+    if action == ACTION_UPSERT and "publishedAt" in model and not model.get("publishedAt"):
+        action = ACTION_DELETE
+    return event, doc_id, action
+
+
+async def schedule_document_event(doc_id: str, action: str) -> int:
+    """登记 (或推迟) 单篇文档的待处理动作，返回到期时间戳。后到的事件覆盖先前的动作。"""
+    if action == ACTION_DELETE:
+        # verify_removed：执行前向 Outline 确认文档确实已删除/归档/撤回，不单凭请求体删除
+        task = {"task": "delete_docs", "doc_ids": [doc_id], "verify_removed": True}
+    else:
+        # track_progress=False：不计入全量刷新的进度计数
+        task = {"task": "process_doc_batch", "doc_ids": [doc_id], "track_progress": False}
+    await schedule(task, config.WEBHOOK_DEBOUNCE_SECONDS, job_id=f"{DOC_JOB_PREFIX}{doc_id}")
+    return int(time.time()) + config.WEBHOOK_DEBOUNCE_SECONDS
+
+
+async def confirm_removed(doc_ids: list) -> list:
+    """返回在 Outline 中确实已不可见 (不存在、已删除、已归档或未发布) 的文档 id。"""
+    removed = []
+    for doc_id in doc_ids:
+        info = await outline_get_doc(doc_id)
+        if not info or info.get("deletedAt") or info.get("archivedAt") or not info.get("publishedAt"):
+            removed.append(doc_id)
+        else:
+            logger.warning(f"Webhook 要求删除的文档 {doc_id} 在 Outline 中仍然存在，忽略删除。")
+    return removed
+
+
+async def schedule_full_refresh(delay: int = 60) -> int:
+    """推迟一次全量刷新 (用于无法定位到单篇文档的事件)。"""
+    await schedule({"task": "refresh_all", "scheduled": True}, delay, job_id=REFRESH_JOB_ID)
+    return int(time.time()) + delay
+
+
+async def ensure_reconcile_scheduled() -> bool:
+    """引导周期性全量对账：尚无调度时登记一次 (之后由每次对账任务自行续约)。"""
+    interval = config.REFRESH_RECONCILE_INTERVAL
+    if interval <= 0:
+        return False
+    return await schedule(
+        {"task": "refresh_all", "scheduled": True, "reconcile": True},
+        interval, job_id=RECONCILE_JOB_ID, only_if_absent=True
+    )
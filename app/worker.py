@@ -0,0 +1,269 @@
+# app/worker.py
+# 后台子系统 (任务处理器、延时任务调度器) 与独立的摄取 worker 入口。
+#
+# Web 进程默认同时运行这些后台任务；设置 RUN_BACKGROUND_WORKERS=false 后
+# Web 进程只负责对话，由单独的进程运行摄取：
+#     python -m worker
+import asyncio
+import json
+import logging
+import signal
+import uuid
+
+import redis.asyncio as redis
+
+import config
+import rag
+import task_queue
+import webhook_events
+from database import db_init, redis_client, redis_binary_client, async_engine
+from outline_client import init_outline_client, close_outline_client
+from rate_limiter import LANE_INGEST, priority_lane
+from scheduler import scheduler_loop
+
+logger = logging.getLogger("worker")
+
+
+async def _dispatch_task(task_data: dict):
+    """按任务类型执行任务；抛出的异常由 task_queue.run_task 负责重试/死信。"""
+    # 后台任务发出的上游请求排在交互式对话请求之后
+    with priority_lane(LANE_INGEST):
+        await _run_task_body(task_data)
+
+
+async def _run_task_body(task_data: dict):
+    task_name = task_data.get("task")
+    logger.info("接收到新任务: %s", task_name)
+
+    if task_name == "refresh_all":
+        if task_data.get("reconcile"):
+            # 先续约下一次周期性对账，即使本次失败也不会中断周期
+            await webhook_events.ensure_reconcile_scheduled()
+        lock_token = task_data.get("lock_token")
+        if lock_token and await redis_client.get("refresh:lock") == lock_token:
+            # 重试沿用失败时保留的刷新锁 (已入队的批次仍计入该次刷新的进度)
+            await redis_client.expire("refresh:lock", 3600)
+        elif task_data.get("scheduled") or task_data.get("_attempts"):
+            # 由调度器投递的刷新 (含失败后的重试) 需自行获取 refresh:lock (手动刷新由 /update/all 获取)
+            if not await redis_client.set("refresh:lock", "1", ex=3600, nx=True):
+                if task_data.get("_attempts"):
+                    # 重试不能被静默确认：抛出后按退避再次重试，直至锁释放或转入死信
+                    raise RuntimeError("refresh:lock is held by another refresh")
+                logger.info("已有刷新在进行中，跳过本次计划刷新。")
+                return
+        try:
+            await rag.refresh_all_task()
+        except Exception as e:
+            # 已有批次入队时 refresh_all_task 不释放锁：将其转交给本任务的重试
+            token = uuid.uuid4().hex
+            if await redis_client.set("refresh:lock", token, ex=3600, xx=True):
+                raise task_queue.PartialTaskFailure(str(e), {**task_data, "lock_token": token}) from e
+            raise
+    elif task_name == "process_doc_batch":
+        try:
+            await rag.process_doc_batch_task(
+                task_data.get("doc_ids", []),
+                task_data.get("docs"),
+                track_progress=task_data.get("track_progress", True)
+            )
+        except rag.DocumentsFailedError as e:
+            raise task_queue.PartialTaskFailure(str(e), _narrow_to_docs(task_data, e.failed_ids)) from e
+    elif task_name == "delete_docs":
+        doc_ids = task_data.get("doc_ids", [])
+        if task_data.get("verify_removed"):
+            doc_ids = await webhook_events.confirm_removed(doc_ids)
+        try:
+            await rag.delete_docs(doc_ids)
+        except rag.DocumentsFailedError as e:
+            raise task_queue.PartialTaskFailure(str(e), _narrow_to_docs(task_data, e.failed_ids)) from e
+    else:
+        logger.warning("未知任务类型: %s", task_name)
+
+
+def _narrow_to_docs(task_data: dict, doc_ids: list) -> dict:
+    """只保留失败文档的任务内容，用于重试与死信。"""
+    wanted = set(doc_ids)
+    narrowed = {**task_data, "doc_ids": [d for d in task_data.get("doc_ids", []) if d in wanted]}
+    if task_data.get("docs"):
+        narrowed["docs"] = [d for d in task_data["docs"] if d.get("id") in wanted]
+    return narrowed
+
+
+async def _on_task_dead(task_data: dict):
+    """任务进入死信流后的补偿：保证全量刷新的锁与进度不会因此卡住。"""
+    task_name = task_data.get("task")
+    if task_name == "refresh_all":
+        status = {"status": "error", "message": "Refresh failed: task exceeded retry limit"}
+        p = redis_client.pipeline()
+        p.delete("refresh:lock", "refresh:listing")
+        p.set("refresh:status", json.dumps(status), ex=300)
+        await p.execute()
+    elif task_name == "process_doc_batch" and task_data.get("track_progress", True):
+        await redis_client.incrby("refresh:skipped_count", len(task_data.get("doc_ids", [])))
+
+
+# 关闭时置位：任务处理器停止领取新任务
+_shutdown_event = asyncio.Event()
+# 本进程正在执行的任务
+_inflight_tasks: set = set()
+
+
+def _task_type_limits() -> dict:
+    """各任务类型的并发上限；未列出的类型只受总槽位限制。"""
+    return {
+        "refresh_all": asyncio.Semaphore(config.TASK_SLOTS_REFRESH_ALL),
+        "process_doc_batch": asyncio.Semaphore(config.TASK_SLOTS_PROCESS_DOC_BATCH),
+        "delete_docs": asyncio.Semaphore(config.TASK_SLOTS_DELETE_DOCS),
+    }
+
+
+async def _run_entry(entry, consumer: str, slots: asyncio.Semaphore, type_sem: asyncio.Semaphore | None):
+    """执行已领取的任务；总槽位与类型槽位已由 task_worker 预留，这里负责归还。"""
+    try:
+        await task_queue.run_task(entry, consumer, _dispatch_task, on_dead=_on_task_dead)
+    except Exception as e:
+        # 多为确认/计数时的 Redis 错误；条目未确认，稍后会被回收
+        logger.exception("任务 %s (%s) 执行后处理失败: %s", entry.name, entry.entry_id, e)
+    finally:
+        if type_sem is not None:
+            type_sem.release()
+        slots.release()
+
+
+def _readable_streams(type_limits: dict, free_slots: int, offset: int) -> list:
+    """
+    本轮可读取的任务流：只包含仍有类型槽位的任务类型 (以及无类型上限的默认流)，
+    数量不超过空闲的总槽位；从 offset 开始轮转，避免总槽位紧张时总是同一个流优先。
+    """
+    streams = [task_queue.STREAM_KEY] + [
+        task_queue.stream_for(name) for name in task_queue.TASK_TYPES
+        if name not in type_limits or not type_limits[name].locked()
+    ]
+    start = offset % len(streams)
+    return (streams[start:] + streams[:start])[:free_slots]
+
+
+async def task_worker():
+    """
+    后台任务处理器，以消费者组方式从 Redis 任务流 (每种任务类型一个流) 中消费任务。
+    每个进程最多并发执行 TASK_WORKER_SLOTS 个任务，且各类型有独立上限 (TASK_SLOTS_*)：
+    某类型已满时本进程不再读取该类型的流，其任务按原顺序留在流中，
+    由本进程稍后或其他进程执行，因此 refresh_all 与批处理任务互不饿死。
+    """
+    consumer = task_queue.consumer_name()
+    logger.info("后台任务处理器已启动 (异步, consumer=%s, slots=%s)。", consumer, config.TASK_WORKER_SLOTS)
+    while True:
+        try:
+            await task_queue.ensure_group()
+            await webhook_events.ensure_reconcile_scheduled()
+            break
+        except redis.ConnectionError as e:
+            logger.error("Redis 连接错误，任务处理器暂停5秒: %s", e)
+            await asyncio.sleep(5)
+
+    slots = asyncio.Semaphore(config.TASK_WORKER_SLOTS)
+    type_limits = _task_type_limits()
+    rotation = 0
+
+    while not _shutdown_event.is_set():
+        # 预留总槽位：至少一个 (阻塞等待)，其余空闲槽位一并预留，每个可读的流对应一个
+        await slots.acquire()
+        reserved = 1
+        while reserved < len(task_queue.ALL_STREAMS) and not slots.locked():
+            await slots.acquire()
+            reserved += 1
+
+        streams = _readable_streams(type_limits, reserved, rotation)
+        rotation += 1
+        # 有类型因槽位已满而未读取时缩短阻塞时间，槽位释放后尽快恢复读取
+        block_ms = 5000 if len(streams) == len(task_queue.ALL_STREAMS) else 1000
+        entries = []
+        try:
+            entries = await task_queue.read_tasks(consumer, streams, block_ms=block_ms)
+        except asyncio.CancelledError:
+            for _ in range(reserved):
+                slots.release()
+            raise
+        except redis.ConnectionError as e:
+            logger.error("Redis 连接错误，任务处理器暂停5秒: %s", e)
+            await asyncio.sleep(5)
+        except Exception as e:
+            logger.exception("任务处理器发生未知错误: %s", e)
+            await asyncio.sleep(1)
+
+        # 每个流最多返回一个条目，且只读取了有类型槽位的流，因此预留的槽位足够
+        for entry in entries:
+            type_sem = type_limits.get(entry.name)
+            if type_sem is not None:
+                await type_sem.acquire()
+            task = asyncio.create_task(_run_entry(entry, consumer, slots, type_sem))
+            _inflight_tasks.add(task)
+            task.add_done_callback(_inflight_tasks.discard)
+        for _ in range(reserved - len(entries)):
+            slots.release()
+
+
+async def drain_task_worker(timeout: float):
+    """停止领取新任务，并等待进行中的任务完成；超时仍未完成的任务被取消 (不确认，稍后由其他 worker 回收)。"""
+    _shutdown_event.set()
+    if not _inflight_tasks:
+        return
+    logger.info("等待 %d 个进行中的任务完成 (最多 %ss)...", len(_inflight_tasks), timeout)
+    _done, pending = await asyncio.wait(set(_inflight_tasks), timeout=timeout)
+    for task in pending:
+        task.cancel()
+    if pending:
+        logger.warning("%d 个任务未在关闭前完成，已取消并留待回收。", len(pending))
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+def start_background_workers() -> list:
+    """启动任务处理器与延时任务调度器，返回后台任务列表 (交给 stop_background_workers)。"""
+    return [
+        asyncio.create_task(task_worker()),
+        asyncio.create_task(scheduler_loop()),
+    ]
+
+
+async def stop_background_workers(tasks: list):
+    """先排空进行中的任务，再取消后台循环。"""
+    await drain_task_worker(config.TASK_DRAIN_TIMEOUT)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def run_worker():
+    """独立 worker 进程：只运行后台子系统，直到收到 SIGTERM/SIGINT。"""
+    if not redis_client:
+        raise SystemExit("独立 worker 需要 REDIS_URL")
+
+    await db_init()
+    await init_outline_client()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    tasks = start_background_workers()
+    logger.info("独立 worker 已启动。")
+    try:
+        await stop.wait()
+    finally:
+        logger.info("独立 worker 正在关闭...")
+        await stop_background_workers(tasks)
+        await close_outline_client()
+        await async_engine.dispose()
+        await redis_client.close()
+        if redis_binary_client:
+            await redis_binary_client.close()
+        logger.info("独立 worker 已退出。")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=getattr(logging, config.LOG_LEVEL, logging.ERROR),
+        format="%(asctime)s %(levelname)s %(name)s - %(message)s"
+    )
+    asyncio.run(run_worker())